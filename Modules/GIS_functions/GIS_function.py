@@ -6,8 +6,22 @@ UNESCO-IHE 2017
 """
 import numpy as np
 from osgeo import gdal
+from osgeo import gdal_array
 from osgeo import osr
 import os
+import threading
+import warnings
+from WaPOR import progress
+
+# GDAL data types of the numpy dtype names, for CreateGeoTiff and BlockWriter
+GDAL_DATATYPES = {"uint8": 1, "int8": 1, "uint16": 2, "int16": 3, "Int16": 3, "uint32": 4,
+"int32": 5, "float32": 6, "float64": 7, "complex64": 10, "complex128": 11,
+"Int32": 5, "Float32": 6, "Float64": 7, "Complex64": 10, "Complex128": 11,}
+
+# numpy types of the dtype names of OpenAsArray
+NUMPY_DATATYPES = {"uint8": np.uint8, "int8": np.int8, "uint16": np.uint16, "int16":  np.int16, "Int16":  np.int16, "uint32": np.uint32,
+"int32": np.int32, "float32": np.float32, "float64": np.float64, "complex64": np.complex64, "complex128": np.complex128,
+"Int32": np.int32, "Float32": np.float32, "Float64": np.float64, "Complex64": np.complex64, "Complex128": np.complex128,}
 
 gdal.UseExceptions()
 
@@ -36,21 +50,180 @@ def GetGeoInfo(fh, subdataset = 0):
         List with geotransform values.
     Projection : str
         Projection of fh.
+        
+    The values come from GridSpec.from_file and are cached until fh changes,
+    every call returns a new Projection object.
     """
-    SourceDS = gdal.Open(fh, gdal.GA_ReadOnly)
-    Type = SourceDS.GetDriver().ShortName
-    if Type == 'HDF4' or Type == 'netCDF':
-        SourceDS = gdal.Open(SourceDS.GetSubDatasets()[subdataset][0])
-    NDV = SourceDS.GetRasterBand(1).GetNoDataValue()
-    xsize = SourceDS.RasterXSize
-    ysize = SourceDS.RasterYSize
-    GeoT = SourceDS.GetGeoTransform()
-    Projection = osr.SpatialReference()
-    Projection.ImportFromWkt(SourceDS.GetProjectionRef())
-    driver = gdal.GetDriverByName(Type)
-    return driver, NDV, xsize, ysize, GeoT, Projection
+    return tuple(GridSpec.from_file(fh, subdataset))
+
+# GridSpecs per path and subdataset, with the mtime and size of the file they were read from
+_grid_specs = {}
+_grid_specs_lock = threading.Lock()
+
+class GridSpec(object):
+    """
+    Grid of a raster: driver, no-data-value, size, geotransform and
+    projection. GridSpec.from_file reads them once per version of a file,
+    later calls for an unchanged file return the cached GridSpec without
+    opening it. A GridSpec can be passed instead of the grid arguments of
+    CreateGeoTiff and as source_file of MatchProjResNDV, and it unpacks like
+    the output of GetGeoInfo:
+    
+    driver, NDV, xsize, ysize, GeoT, Projection = GridSpec.from_file(fh)
+    
+    Parameters
+    ----------
+    driver : str
+        Short name of the GDAL driver.
+    NDV : float
+        No-data-value, None if not set.
+    xsize : int
+        Amount of pixels in x direction.
+    ysize : int
+        Amount of pixels in y direction.
+    GeoT : list
+        List with geotransform values.
+    wkt : str
+        Projection as WKT.
+    """
+    def __init__(self, driver, NDV, xsize, ysize, GeoT, wkt):
+        self.driver_name = driver
+        self.NDV = NDV
+        self.xsize = int(xsize)
+        self.ysize = int(ysize)
+        self.GeoT = tuple(GeoT)
+        self.wkt = wkt
+
+    @classmethod
+    def from_file(cls, fh, subdataset = 0):
+        """
+        GridSpec of fh, read from the file only if it changed since the last
+        call. Paths that are not files on disk, like /vsimem/ files and HDF4
+        subdatasets, are read every time.
+        
+        Parameters
+        ----------
+        fh : str
+            Filehandle to file to be scrutinized.
+        subdataset : int, optional
+            Layer to be used in case of HDF4 or netCDF format, default is 0.
+        
+        Returns
+        -------
+        grid : GridSpec
+            Grid of fh.
+        """
+        try:
+            stat = os.stat(fh)
+        except OSError:
+            key = None
+        else:
+            key = (os.path.abspath(fh), subdataset)
+            version = (stat.st_mtime_ns, stat.st_size)
+            with _grid_specs_lock:
+                cached = _grid_specs.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        SourceDS = gdal.Open(fh, gdal.GA_ReadOnly)
+        Type = SourceDS.GetDriver().ShortName
+        if Type == 'HDF4' or Type == 'netCDF':
+            SourceDS = gdal.Open(SourceDS.GetSubDatasets()[subdataset][0])
+        Projection = osr.SpatialReference()
+        Projection.ImportFromWkt(SourceDS.GetProjectionRef())
+        grid = cls(Type, SourceDS.GetRasterBand(1).GetNoDataValue(), SourceDS.RasterXSize,
+                   SourceDS.RasterYSize, SourceDS.GetGeoTransform(), Projection.ExportToWkt())
+        if key is not None:
+            with _grid_specs_lock:
+                _grid_specs[key] = (version, grid)
+        return grid
+
+    @property
+    def driver(self):
+        return gdal.GetDriverByName(self.driver_name)
+
+    @property
+    def Projection(self):
+        """
+        New osr.SpatialReference of the grid, the GridSpec keeps only the WKT.
+        """
+        Projection = osr.SpatialReference()
+        Projection.ImportFromWkt(self.wkt)
+        return Projection
+
+    @property
+    def shape(self):
+        return (self.ysize, self.xsize)
+
+    @property
+    def extent(self):
+        """
+        Lower left and upper right corner, (xmin, ymin, xmax, ymax) for
+        north-up grids.
+        """
+        GeoT = self.GeoT
+        return (GeoT[0] + self.ysize * GeoT[2], GeoT[3] + self.ysize * GeoT[5],
+                GeoT[0] + self.xsize * GeoT[1], GeoT[3] + self.xsize * GeoT[4])
+
+    def window(self, xmin, ymin, xmax, ymax):
+        """
+        Pixel window of a north-up grid that covers a bounding box, clipped
+        to the grid.
+        
+        Parameters
+        ----------
+        xmin, ymin, xmax, ymax : float
+            Bounding box in the projection of the grid.
+        
+        Returns
+        -------
+        xoff, yoff, win_xsize, win_ysize : int
+            Offset and size of the window in pixels, the sizes are 0 if the
+            box is outside the grid.
+        """
+        GeoT = self.GeoT
+        # a tolerance of 1e-6 pixel keeps bounds on pixel edges from adding a row or column
+        x0 = int(np.floor((xmin - GeoT[0]) / GeoT[1] + 1e-6))
+        x1 = int(np.ceil((xmax - GeoT[0]) / GeoT[1] - 1e-6))
+        y0 = int(np.floor((ymax - GeoT[3]) / GeoT[5] + 1e-6))
+        y1 = int(np.ceil((ymin - GeoT[3]) / GeoT[5] - 1e-6))
+        x0, x1 = min(max(x0, 0), self.xsize), min(max(x1, 0), self.xsize)
+        y0, y1 = min(max(y0, 0), self.ysize), min(max(y1, 0), self.ysize)
+        return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+    def aligned(self, other):
+        """
+        True if other has the same size, geotransform and projection, so
+        that their pixels can be combined without resampling.
+        """
+        return (self.xsize, self.ysize, self.GeoT, self.wkt) == (other.xsize, other.ysize, other.GeoT, other.wkt)
+
+    def __iter__(self):
+        return iter((self.driver, self.NDV, self.xsize, self.ysize, self.GeoT, self.Projection))
+
+    def __eq__(self, other):
+        if not isinstance(other, GridSpec):
+            return NotImplemented
+        return (self.driver_name, self._ndv_key()) == (other.driver_name, other._ndv_key()) and self.aligned(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.driver_name, self._ndv_key(), self.xsize, self.ysize, self.GeoT, self.wkt))
+
+    def _ndv_key(self):
+        # a NaN no-data-value equals itself
+        if self.NDV is not None and np.isnan(self.NDV):
+            return 'nan'
+        return self.NDV
+
+    def __repr__(self):
+        return 'GridSpec({0!r}, {1!r}, {2!r}, {3!r}, {4!r}, ...)'.format(
+            self.driver_name, self.NDV, self.xsize, self.ysize, self.GeoT)
 
-def OpenAsArray(fh, bandnumber = 1, dtype = 'float32', nan_values = False):
+
+def OpenAsArray(fh, bandnumber = 1, dtype = 'float32', nan_values = False, out = None):
     """
     Open a map as an numpy array. 
     
@@ -65,15 +238,21 @@ def OpenAsArray(fh, bandnumber = 1, dtype = 'float32', nan_values = False):
     nan_values : boolean, optional
         Convert he no-data-values into np.nan values, note that dtype needs to
         be a float if True. Default is False.
+    out : ndarray, optional
+        Array with the shape of the band to read into, e.g. the array of the
+        previous time step in a loop, its dtype is used instead of dtype.
+        Default is None to allocate a new array.
         
     Returns
     -------
     Array : ndarray
-        Array with the pixel values.
+        Array with the pixel values, out if it is given.
+        
+    The values are converted to dtype by GDAL while reading where that gives
+    the same values as astype, e.g. int16 to float32, and the scale and
+    no-data-values are applied in place, a few rows at a time, so that no
+    copies of the whole array are made.
     """
-    datatypes = {"uint8": np.uint8, "int8": np.int8, "uint16": np.uint16, "int16":  np.int16, "Int16":  np.int16, "uint32": np.uint32,
-    "int32": np.int32, "float32": np.float32, "float64": np.float64, "complex64": np.complex64, "complex128": np.complex128,
-    "Int32": np.int32, "Float32": np.float32, "Float64": np.float64, "Complex64": np.complex64, "Complex128": np.complex128,}
     DataSet = gdal.Open(fh, gdal.GA_ReadOnly)
     Type = DataSet.GetDriver().ShortName
     if Type == 'HDF4':
@@ -82,12 +261,94 @@ def OpenAsArray(fh, bandnumber = 1, dtype = 'float32', nan_values = False):
     else:
         Subdataset = DataSet.GetRasterBand(bandnumber)
         NDV = Subdataset.GetNoDataValue()
-    Array = Subdataset.ReadAsArray().astype(datatypes[dtype])
+    Array = _ReadAsArray(Subdataset, NUMPY_DATATYPES[dtype], out = out)
+    if Type != 'HDF4':
+        Array = ApplyScale(Subdataset, Array, NDV, inplace = True)
     if nan_values:
-        Array[Array == NDV] = np.nan
+        for Block in _RowChunks(Array):
+            Block[Block == NDV] = np.nan
+    return Array
+
+def _ReadAsArray(Source, dtype, window = (), out = None):
+    """
+    Reads a band, or a dataset, into out or into a new array of dtype.
+    
+    GDAL converts the values while reading, so no copy is made for the cast,
+    only if the conversion cannot change them: the same type, float to float
+    or a type that numpy casts safely, e.g. int16 to float32. Other reads are
+    cast after reading as with ReadAsArray().astype(dtype), because GDAL
+    rounds floats to integers where numpy truncates, and sets NaN to 0.
+    """
+    if out is not None:
+        dtype = out.dtype
+    dtype = np.dtype(dtype)
+    Band = Source.GetRasterBand(1) if hasattr(Source, 'GetRasterBand') else Source
+    src_type = gdal_array.GDALTypeCodeToNumericTypeCode(Band.DataType)
+    if src_type is None or not (np.dtype(src_type) == dtype or np.can_cast(src_type, dtype, 'safe') or
+                                (np.dtype(src_type).kind == 'f' and dtype.kind == 'f')):
+        if out is None:
+            return Source.ReadAsArray(*window).astype(dtype)
+        out[...] = Source.ReadAsArray(*window)
+        return out
+    if out is not None:
+        return Source.ReadAsArray(*window, buf_obj = out)
+    buf_type = Band.DataType if np.dtype(src_type) == dtype else gdal_array.NumericTypeCodeToGDALTypeCode(dtype.type)
+    if buf_type is None:
+        return Source.ReadAsArray(*window).astype(dtype)
+    return Source.ReadAsArray(*window, buf_type = buf_type)
+
+def _RowChunks(Array, size = 1 << 20):
+    """
+    Views of about size values of Array, split along the first axis, so that
+    masks of whole arrays are not needed.
+    """
+    rows = max(1, size // max(1, Array[0].size)) if Array.ndim > 1 else size
+    for i in range(0, Array.shape[0], rows):
+        yield Array[i:i + rows]
+
+def ApplyScale(Band, Array, NDV, inplace = False):
+    """
+    Applies the scale and offset of a band to its array, no-data-values are
+    kept. Rasters written by ScaleGeoTiff with compact = True carry their
+    MULTIPLIER (and NDAYS) as metadata, which are applied in the same order
+    as for a float32 download so that the values are identical.
+    
+    Parameters
+    ----------
+    Band : object
+        GDAL band the array was read from.
+    Array : ndarray
+        Array with the raw pixel values.
+    NDV : float
+        No-data-value of the band.
+    inplace : boolean, optional
+        Scale Array itself instead of a copy, default is False.
+        
+    Returns
+    -------
+    Array : ndarray
+        Array with the scaled pixel values, with the dtype of the input.
+    """
+    Scale = Band.GetScale()
+    Offset = Band.GetOffset()
+    Metadata = Band.GetMetadata()
+    if Scale in (None, 1) and Offset in (None, 0) and 'MULTIPLIER' not in Metadata:
+        return Array
+    if not inplace:
+        Array = Array.copy()
+    for Block in _RowChunks(Array):
+        Mask = Block == NDV
+        if 'MULTIPLIER' in Metadata:
+            Scaled = Block * float(Metadata['MULTIPLIER'])
+            if 'NDAYS' in Metadata:
+                Scaled = Scaled * float(Metadata['NDAYS'])
+        else:
+            Scaled = Block * (1 if Scale is None else Scale) + (0 if Offset is None else Offset)
+        Block[...] = Scaled
+        Block[Mask] = NDV
     return Array
 
-def CreateGeoTiff(fh, Array, driver, NDV, xsize, ysize, GeoT, Projection, explicit = True, compress = None):
+def CreateGeoTiff(fh, Array, driver, NDV = None, xsize = None, ysize = None, GeoT = None, Projection = None, explicit = True, compress = None):
     """
     Creates a geotiff from a numpy array.
     
@@ -97,8 +358,10 @@ def CreateGeoTiff(fh, Array, driver, NDV, xsize, ysize, GeoT, Projection, explic
         Filehandle for output.
     Array: ndarray
         Array to convert to geotiff.
-    driver : str
-        Driver of the fh.
+    driver : str or GridSpec
+        Driver of the fh, or the GridSpec of fh which gives all of driver,
+        NDV, xsize, ysize, GeoT and Projection. The VRT driver of a .vrt
+        template is replaced by GTiff.
     NDV : float
         No-data-value of the fh.
     xsize : int
@@ -108,37 +371,202 @@ def CreateGeoTiff(fh, Array, driver, NDV, xsize, ysize, GeoT, Projection, explic
     GeoT : list
         List with geotransform values.
     Projection : str
-        Projection of fh.    
+        Projection of fh, an osr.SpatialReference or WKT.
     """
-    datatypes = {"uint8": 1, "int8": 1, "uint16": 2, "int16": 3, "Int16": 3, "uint32": 4,
-    "int32": 5, "float32": 6, "float64": 7, "complex64": 10, "complex128": 11,
-    "Int32": 5, "Float32": 6, "Float64": 7, "Complex64": 10, "Complex128": 11,}
+    if isinstance(driver, GridSpec):
+        driver, NDV, xsize, ysize, GeoT, Projection = driver.driver, driver.NDV, driver.xsize, driver.ysize, driver.GeoT, driver.wkt
+    driver = _OutputDriver(driver)
     if compress != None:
-        DataSet = driver.Create(fh,xsize,ysize,1,datatypes[Array.dtype.name], ['COMPRESS={0}'.format(compress)])
+        DataSet = driver.Create(fh,xsize,ysize,1,GDAL_DATATYPES[Array.dtype.name], ['COMPRESS={0}'.format(compress)])
     else:
-        DataSet = driver.Create(fh,xsize,ysize,1,datatypes[Array.dtype.name])
+        DataSet = driver.Create(fh,xsize,ysize,1,GDAL_DATATYPES[Array.dtype.name])
     if NDV is None:
         NDV = -9999
     if explicit:
         Array[np.isnan(Array)] = NDV
     DataSet.GetRasterBand(1).SetNoDataValue(NDV)
     DataSet.SetGeoTransform(GeoT)
-    DataSet.SetProjection(Projection.ExportToWkt())
+    DataSet.SetProjection(Projection if isinstance(Projection, str) else Projection.ExportToWkt())
     DataSet.GetRasterBand(1).WriteArray(Array)
     DataSet = None
     if "nt" not in Array.dtype.name:
         Array[Array == NDV] = np.nan
 
+def _OutputDriver(driver):
+    """
+    Driver to write an array with, GTiff instead of the VRT driver of a
+    template that is a VRT, as a VRT cannot store the pixel values.
+    """
+    if driver.ShortName == 'VRT':
+        return gdal.GetDriverByName('GTiff')
+    return driver
+
+
+def IterBlocks(fhs, block_size = None, bandnumber = 1, dtype = 'float32', nan_values = False):
+    """
+    Reads one or several aligned rasters block by block, as OpenAsArray does
+    for the whole band, so that rasters larger than memory can be processed
+    one window at a time. Use BlockWriter to save the results:
+    
+    with BlockWriter(output_fh, AETI_fh) as writer:
+        for window, (AETI, T) in IterBlocks([AETI_fh, T_fh], nan_values = True):
+            writer.write(window, T / AETI)
+    
+    Parameters
+    ----------
+    fhs : str or list
+        Filehandle or filehandles of rasters with the same size, geotransform
+        and projection.
+    block_size : int or tuple, optional
+        Size of the windows in pixels, (xsize, ysize) or one value for square
+        windows. Default is None to use the block size of the first raster,
+        whole rows of at least 256 rows for striped files.
+    bandnumber : int, optional 
+        Band to read, default is 1.
+    dtype : str, optional
+        Datatype of output arrays, default is 'float32'.
+    nan_values : boolean, optional
+        Convert the no-data-values into np.nan values, note that dtype needs
+        to be a float if True. Default is False.
+        
+    Yields
+    ------
+    window : tuple
+        Offset and size of the window in pixels, (xoff, yoff, win_xsize,
+        win_ysize).
+    Arrays : ndarray or list
+        Array of the window, or a list with one array per raster if fhs is a
+        list.
+    """
+    single = isinstance(fhs, str)
+    if single:
+        fhs = [fhs]
+    grid = GridSpec.from_file(fhs[0])
+    for fh in fhs[1:]:
+        if not GridSpec.from_file(fh).aligned(grid):
+            raise ValueError('{0} is not aligned with {1}'.format(fh, fhs[0]))
+    DataSets = [gdal.Open(fh, gdal.GA_ReadOnly) for fh in fhs]
+    Bands = [DataSet.GetRasterBand(bandnumber) for DataSet in DataSets]
+    NDVs = [Band.GetNoDataValue() for Band in Bands]
+    if block_size is None:
+        block_xsize, block_ysize = Bands[0].GetBlockSize()
+        if block_xsize >= grid.xsize:
+            block_xsize, block_ysize = grid.xsize, max(block_ysize, 256)
+    elif np.isscalar(block_size):
+        block_xsize = block_ysize = int(block_size)
+    else:
+        block_xsize, block_ysize = block_size
+    for yoff in range(0, grid.ysize, block_ysize):
+        win_ysize = min(block_ysize, grid.ysize - yoff)
+        for xoff in range(0, grid.xsize, block_xsize):
+            win_xsize = min(block_xsize, grid.xsize - xoff)
+            Arrays = []
+            for Band, NDV in zip(Bands, NDVs):
+                Array = _ReadAsArray(Band, dtype, (xoff, yoff, win_xsize, win_ysize))
+                Array = ApplyScale(Band, Array, NDV, inplace = True)
+                if nan_values:
+                    Array[Array == NDV] = np.nan
+                Arrays.append(Array)
+            window = (xoff, yoff, win_xsize, win_ysize)
+            yield window, Arrays[0] if single else Arrays
+
+
+class BlockWriter(object):
+    """
+    Writes a geotiff window by window, the counterpart of IterBlocks. The
+    file is the same as the one CreateGeoTiff writes from the whole array.
+    
+    Parameters
+    ----------
+    fh : str
+        Filehandle for output.
+    grid : str or GridSpec
+        Raster or GridSpec to take the size, geotransform, projection and
+        no-data-value from, the output is always a GeoTIFF.
+    dtype : str, optional
+        Datatype of output, default is 'float32'.
+    NDV : float, optional
+        No-data-value of the output, default is None to use the one of grid,
+        or -9999 if grid has none.
+    compress : str, optional
+        Compression of the output, e.g. 'LZW', default is None.
+    explicit : boolean, optional
+        Write np.nan values as NDV, default is True.
+    """
+    def __init__(self, fh, grid, dtype = 'float32', NDV = None, compress = None, explicit = True):
+        if not isinstance(grid, GridSpec):
+            grid = GridSpec.from_file(grid)
+        if NDV is None:
+            NDV = grid.NDV
+        if NDV is None:
+            NDV = -9999
+        self.fh = fh
+        self.grid = grid
+        self.dtype = np.dtype(dtype)
+        self.NDV = NDV
+        self.explicit = explicit
+        if compress != None:
+            self.DataSet = gdal.GetDriverByName('GTiff').Create(fh, grid.xsize, grid.ysize, 1, GDAL_DATATYPES[self.dtype.name], ['COMPRESS={0}'.format(compress)])
+        else:
+            self.DataSet = gdal.GetDriverByName('GTiff').Create(fh, grid.xsize, grid.ysize, 1, GDAL_DATATYPES[self.dtype.name])
+        self.DataSet.GetRasterBand(1).SetNoDataValue(NDV)
+        self.DataSet.SetGeoTransform(grid.GeoT)
+        self.DataSet.SetProjection(grid.wkt)
+
+    def write(self, window, Array):
+        """
+        Writes Array to window, a window yielded by IterBlocks.
+        """
+        Array = np.array(Array)
+        if self.explicit and Array.dtype.kind in 'fc':
+            Array[np.isnan(Array)] = self.NDV
+        Array = Array.astype(self.dtype, copy = False)
+        self.DataSet.GetRasterBand(1).WriteArray(Array, window[0], window[1])
+
+    def close(self):
+        self.DataSet = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-def MatchProjResNDV(source_file, target_fhs, output_folder, resample = 'near', dtype = 'float32', scale = None, ndv_to_zero = False):
+
+def CopyScale(src_fh, dst_fh):
+    """
+    Copies the scale, offset and metadata of the first band of src_fh to the
+    first band of dst_fh, so that OpenAsArray applies the same scale to both.
+    
+    Parameters
+    ----------
+    src_fh : str
+        Filehandle of the raster with the scale.
+    dst_fh : str
+        Filehandle of the raster to update.
+    """
+    SourceBand = gdal.Open(src_fh, gdal.GA_ReadOnly).GetRasterBand(1)
+    DataSet = gdal.Open(dst_fh, gdal.GA_Update)
+    Band = DataSet.GetRasterBand(1)
+    if SourceBand.GetScale() is not None:
+        Band.SetScale(SourceBand.GetScale())
+    if SourceBand.GetOffset() is not None:
+        Band.SetOffset(SourceBand.GetOffset())
+    Band.SetMetadata(SourceBand.GetMetadata())
+    DataSet = None
+
+
+def MatchProjResNDV(source_file, target_fhs, output_folder, resample = 'near', dtype = 'float32', scale = None, ndv_to_zero = False,
+                    processes = None, multithread = False, warp_memory = None, output_format = 'GTiff', Waitbar = 1):
     """
     Matches the projection, resolution and no-data-value of a list of target-files
     with a source-file and saves the new maps in output_folder.
     
     Parameters
     ----------
-    source_file : str
-        The file to match the projection, resolution and ndv with.
+    source_file : str or GridSpec
+        The file to match the projection, resolution and ndv with, or its
+        GridSpec.
     target_fhs : list
         The files to be reprojected.
     output_folder : str
@@ -148,45 +576,190 @@ def MatchProjResNDV(source_file, target_fhs, output_folder, resample = 'near', d
     dtype : str, optional
         Datatype of output, default is 'float32'.
     scale : int, optional
-        Multiple all maps with this value, default is None.
+        Multiple all maps with this value, default is None. With scale or
+        ndv_to_zero each file is warped in memory and written once, one block
+        of rows at a time.
+    processes : int, optional
+        Number of worker processes the target files are spread over, default
+        is None to process the files one by one in this process.
+    multithread : bool, optional
+        Warp each file with GDAL's multithreaded warper, default is False. It
+        uses all cores, or an equal share of them per worker process.
+    warp_memory : float, optional
+        Memory of the warper per file in MB (warpMemoryLimit), default is
+        None to use GDAL's default.
+    output_format : str, optional
+        'GTiff' to write resampled GeoTIFFs, 'VRT' to write warped VRTs
+        (<name>.vrt) that resample the target-file when they are read, only
+        for the windows that are read. The scale and ndv_to_zero options need
+        the resampled values, with them GeoTIFFs are written and a warning is
+        given. Default is 'GTiff'.
+    Waitbar : int, str, callable, list or Progress, optional
+        1 to print a progress bar, default. See WaPOR.progress.progress for
+        JSON lines logs, callbacks and a Progress shared with other loops,
+        which counts the written files and the failures.
     
     Returns
     -------
     output_files : ndarray 
         Filehandles of the created files.
+    
+    Target-files with a scale, e.g. downloads with compact = True, are written
+    as float32 GeoTIFFs with the scale applied, for any resample method.
     """
-    dst_info=gdal.Info(gdal.Open(source_file),format='json')
-    output_files = np.array([])
+    dst_grid = source_file if isinstance(source_file, GridSpec) else GridSpec.from_file(source_file)
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    for target_file in target_fhs:
-        folder, fn = os.path.split(target_file)
-        src_info=gdal.Info(gdal.Open(target_file),format='json')
-        output_file = os.path.join(output_folder, fn)
-        gdal.Warp(output_file,target_file,format='GTiff',
-                      srcSRS=src_info['coordinateSystem']['wkt'],
-                      dstSRS=dst_info['coordinateSystem']['wkt'],
-                      srcNodata=src_info['bands'][0]['noDataValue'],
-                      dstNodata=dst_info['bands'][0]['noDataValue'],
-                      width=dst_info['size'][0],
-                      height=dst_info['size'][1],
-                      outputBounds=(dst_info['cornerCoordinates']['lowerLeft'][0],
-                                    dst_info['cornerCoordinates']['lowerLeft'][1],
-                                    dst_info['cornerCoordinates']['upperRight'][0],
-                                    dst_info['cornerCoordinates']['upperRight'][1]),
-                      outputBoundsSRS=dst_info['coordinateSystem']['wkt'],
-                      resampleAlg=resample)
-        output_files = np.append(output_files, output_file)
-        if not np.any([scale == 1.0, scale == None, scale == 1]):
-            driver, NDV, xsize, ysize, GeoT, Projection = GetGeoInfo(output_file)
-            DATA = OpenAsArray(output_file, nan_values = True) * scale
-            CreateGeoTiff(output_file, DATA, driver, NDV, xsize, ysize, GeoT, Projection)
+    threads = None
+    if multithread:
+        threads = 'ALL_CPUS' if not processes or processes <= 1 else max(1, os.cpu_count() // processes)
+    if output_format == 'VRT' and (not np.any([scale == 1.0, scale == None, scale == 1]) or ndv_to_zero):
+        warnings.warn("MatchProjResNDV writes GeoTIFFs instead of VRTs when scale or ndv_to_zero is set")
+        output_format = 'GTiff'
+    args = [(target_file, dst_grid, output_folder, resample, scale, ndv_to_zero, threads, warp_memory, output_format)
+            for target_file in target_fhs]
+    bar = progress.progress(Waitbar, len(args), name = 'MatchProjResNDV')
+    try:
+        if not processes or processes <= 1 or len(args) <= 1:
+            output_files = [_ReportFile(bar, arg[0], _MatchProjResNDVFile, *arg) for arg in args]
+        else:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            output_files = [None] * len(args)
+            with ProcessPoolExecutor(max_workers = processes) as executor:
+                futures = {executor.submit(_MatchProjResNDVFile, *arg): i for i, arg in enumerate(args)}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    output_files[i] = _ReportFile(bar, args[i][0], future.result)
+    finally:
+        if bar is not Waitbar:
+            bar.close()
+    return np.array(output_files)
+
+
+def _ReportFile(bar, target_file, func, *args):
+    """
+    Returns func(*args) and counts target_file as done in bar, or as failed
+    if func raises.
+    """
+    try:
+        output_file = func(*args)
+    except Exception as e:
+        print('\nERROR: Cannot resample {0}. {1}'.format(target_file, e))
+        bar.item(target_file, e)
+        raise
+    bar.item(target_file)
+    return output_file
+
+
+def _MatchProjResNDVFile(target_file, dst_grid, output_folder, resample, scale, ndv_to_zero, threads = None, warp_memory = None, output_format = 'GTiff'):
+    """
+    Warps one target-file of MatchProjResNDV to dst_grid, runs in
+    the worker processes of the parallel mode.
+    """
+    folder, fn = os.path.split(target_file)
+    src_grid = GridSpec.from_file(target_file)
+    TargetBand = gdal.Open(target_file).GetRasterBand(1)
+    scaled = (TargetBand.GetScale() not in (None, 1) or TargetBand.GetOffset() not in (None, 0) or
+              'MULTIPLIER' in TargetBand.GetMetadata())
+    if output_format == 'VRT' and scaled:
+        warnings.warn("{0} is scaled, MatchProjResNDV writes a GeoTIFF with the scaled values instead of a VRT".format(target_file))
+        output_format = 'GTiff'
+    if output_format == 'VRT':
+        # the VRT refers to the target-file, which must be found from any folder
+        target_file = os.path.abspath(target_file)
+        fn = os.path.splitext(fn)[0] + '.vrt'
+    output_file = os.path.join(output_folder, fn)
+    # warp scaled (compact) rasters as floats and write them with the scale applied,
+    # so that readers that ignore the scale, e.g. rasterio, get the real values
+    OutputType = gdal.GDT_Float32 if scaled else gdal.GDT_Unknown
+    # the multithreaded warper and the memory limit give the same pixels as the default warper
+    options = {}
+    if threads is not None:
+        options['multithread'] = True
+        options['warpOptions'] = ['NUM_THREADS={0}'.format(threads)]
+    if warp_memory is not None:
+        options['warpMemoryLimit'] = warp_memory
+    options.update(srcSRS=src_grid.wkt,
+                   dstSRS=dst_grid.wkt,
+                   srcNodata=src_grid.NDV,
+                   dstNodata=dst_grid.NDV,
+                   width=dst_grid.xsize,
+                   height=dst_grid.ysize,
+                   outputBounds=dst_grid.extent,
+                   outputBoundsSRS=dst_grid.wkt,
+                   resampleAlg=resample,
+                   outputType=OutputType)
+    if scaled or not np.any([scale == 1.0, scale == None, scale == 1]) or ndv_to_zero:
+        # warp to an in-memory VRT and write the scaled file once, block by block
+        Warped = gdal.Warp('', target_file, format='VRT', **options)
+        _WriteScaledNDV(Warped, output_file, TargetBand if scaled else None, scale, ndv_to_zero)
+        Warped = None
+        return output_file
+    gdal.Warp(output_file, target_file, format=output_format, **options)
+    return output_file
+
+
+def _WriteScaledNDV(SourceDS, dst_fh, ScaleBand, scale, ndv_to_zero):
+    """
+    Writes the warped SourceDS to dst_fh with the scale of ScaleBand applied,
+    multiplied with scale and/or with its no-data-values set to 0, one block
+    of rows at a time. Gives the same file as saving the warped raster and
+    correcting it with OpenAsArray and CreateGeoTiff once for scale and once
+    for ndv_to_zero.
+    
+    Parameters
+    ----------
+    SourceDS : object
+        GDAL dataset of the warped raster.
+    dst_fh : str
+        Filehandle for output.
+    ScaleBand : object
+        Band with the scale (and MULTIPLIER metadata) of the warped raster,
+        None if it is not scaled.
+    scale : float
+        Value to multiply the raster with, None or 1 to not multiply.
+    ndv_to_zero : boolean
+        Set the no-data-values to 0.
+    """
+    SourceBand = SourceDS.GetRasterBand(1)
+    NDV = SourceBand.GetNoDataValue()
+    xsize = SourceDS.RasterXSize
+    ysize = SourceDS.RasterYSize
+    Projection = osr.SpatialReference()
+    Projection.ImportFromWkt(SourceDS.GetProjectionRef())
+    multiply = not np.any([scale == 1.0, scale == None, scale == 1])
+    # data type and no-data-value that each CreateGeoTiff step gives
+    OutNDV = NDV
+    dtype = np.dtype(np.float32)
+    if multiply:
+        OutNDV = -9999 if OutNDV is None else OutNDV
+        dtype = (np.zeros(1, np.float32) * scale).dtype
+    ScaledNDV = OutNDV
+    if ndv_to_zero:
+        OutNDV = -9999 if OutNDV is None else OutNDV
+        dtype = np.dtype(np.float32)
+    DataSet = gdal.GetDriverByName('GTiff').Create(dst_fh, xsize, ysize, 1,
+                                                    gdal.GDT_Float64 if dtype == np.float64 else gdal.GDT_Float32)
+    if OutNDV is not None:
+        DataSet.GetRasterBand(1).SetNoDataValue(OutNDV)
+    DataSet.SetGeoTransform(SourceDS.GetGeoTransform())
+    DataSet.SetProjection(Projection.ExportToWkt())
+    block_rows = max(SourceBand.GetBlockSize()[1], 256)
+    for yoff in range(0, ysize, block_rows):
+        rows = min(block_rows, ysize - yoff)
+        Array = _ReadAsArray(SourceBand, np.float32, (0, yoff, xsize, rows))
+        if ScaleBand is not None:
+            Array = ApplyScale(ScaleBand, Array, NDV, inplace = True)
+        if multiply:
+            Array[Array == NDV] = np.nan
+            Array = Array * scale
+            Array[np.isnan(Array)] = ScaledNDV
         if ndv_to_zero:
-            driver, NDV, xsize, ysize, GeoT, Projection = GetGeoInfo(output_file)
-            DATA = OpenAsArray(output_file, nan_values = False)
-            DATA[DATA == NDV] = 0.0
-            CreateGeoTiff(output_file, DATA, driver, NDV, xsize, ysize, GeoT, Projection)
-    return output_files
+            Array = Array.astype(np.float32)
+            Array[Array == ScaledNDV] = 0.0
+            Array[np.isnan(Array)] = OutNDV
+        DataSet.GetRasterBand(1).WriteArray(Array, 0, yoff)
+    DataSet = None
 
 
 def printWaitBar(i, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█'):
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio variant of the WaPOR API class.
+
+AsyncWaPORClient mirrors getAvailData, getCropRasterURL, _query_jobOutput,
+getPixelTimeseries and getAreaTimeseries of __WaPOR_API_class as coroutines
+sharing one aiohttp session, so that one event loop keeps many job polls and
+raster transfers in flight without a thread per request. Catalog lookups,
+request payloads and response parsing are done by the synchronous API object
+of the client (client.api), the catalog lookups run in a thread as they may
+read the catalog file or query the server. Methods without a coroutine
+version, ex. getRasterUrl or getPixelTimeseriesBatch, are called on
+client.api; it shares the token, caches and request statistics. base_url points the client to another server, e.g. a local stand-in
+of the gismgr endpoints. The access token is kept by a TokenManager, which
+can be shared with the synchronous API.
+
+Example:
+import asyncio
+from WaPOR.AsyncWaporAPI import AsyncWaPORClient
+
+async def crop_urls(APIToken,bbox):
+    async with AsyncWaPORClient(APIToken) as client:
+        df_avail=await client.getAvailData('L2_AETI_D',time_range='2020-01-01,2020-12-31')
+        return await asyncio.gather(*[client.getCropRasterURL(bbox,'L2_AETI_D',
+                                                              row['time_code'],
+                                                              row['raster_id'])
+                                      for i,row in df_avail.iterrows()])
+"""
+import asyncio
+import functools
+import json
+import time
+import aiohttp
+from .WaporAPI import __WaPOR_API_class
+
+_API_class=__WaPOR_API_class #class bodies would mangle the name
+
+
+def _shared(name):
+    '''
+    Attribute of the synchronous API object of the client
+    '''
+    return property(lambda self: getattr(self.api,name),
+                    lambda self,value: setattr(self.api,name,value))
+
+
+class AsyncWaPORClient(object):
+    version=_shared('version')
+    print_job=_shared('print_job')
+    poll_interval=_shared('poll_interval')
+    poll_max_interval=_shared('poll_max_interval')
+    poll_backoff=_shared('poll_backoff')
+    max_pending_jobs=_shared('max_pending_jobs')
+    members_cache=_shared('members_cache')
+    members_ttl=_shared('members_ttl')
+    area_cache=_shared('area_cache')
+    transport=_shared('transport')
+    tokens=_shared('tokens')
+
+    def __init__(self,APIToken,max_connections=100,timeout=(10,300),retries=5,
+                 base_url=r'https://io.apps.fao.org/gismgr/api/v1/',tokens=None):
+        '''
+        APIToken: str
+            WaPOR API token
+        max_connections: int
+            maximum number of simultaneous connections of the session
+        timeout: tuple
+            (connect, read) timeout in seconds of every request
+        retries: int
+            number of retries of a request after a connection error,
+            timeout or 429/5xx answer, POST requests only if they did not
+            reach the server or got a 429/503 answer
+        base_url: str
+            root url of the gismgr API, ending with '/'
+        tokens: TokenManager
+            access token shared with other clients, ex. WaPOR.API.tokens,
+            default a new one
+
+        The client signs in on the first authenticated request.
+        '''
+        self.api=_API_class(APIToken,16,timeout,retries,base_url)
+        if tokens is not None:
+            self.tokens=tokens
+        self.max_connections=max_connections
+        self.session=None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self,*exc_info):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            connect,read=self.transport.timeout
+            self.session=aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect,sock_read=read))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session=None
+
+    async def _query(self,method,url,endpoint,AccessToken=None,**kwargs):
+        '''
+        Send a request and return the json response, retrying like
+        Transport.request and counting into self.transport.stats. With
+        AccessToken the request is authorized, a token the server rejects
+        with 401 is renewed and the request is sent once more.
+        '''
+        await self.open()
+        transport=self.transport
+        attempt=0
+        renewed=False
+        while True:
+            if AccessToken is not None:
+                kwargs['headers']=dict(kwargs.get('headers',{}),
+                                       Authorization='Bearer {0}'.format(AccessToken))
+            start=time.perf_counter()
+            status=headers=error=None
+            sent=True
+            try:
+                async with self.session.request(method,url,**kwargs) as resp:
+                    status,headers=resp.status,resp.headers
+                    body=await resp.read()
+            except aiohttp.ClientConnectorError as e:
+                error=e
+                sent=False
+            except (aiohttp.ClientError,asyncio.TimeoutError) as e:
+                error=e
+            transport._count(endpoint,time.perf_counter()-start,
+                             retry=attempt>0,
+                             error=error is not None or status>=400)
+            if status==401 and AccessToken is not None and not renewed:
+                #revoked on the server before it expired
+                self.tokens.invalidate(AccessToken)
+                AccessToken=await self._get_accessToken()
+                renewed=True
+                continue
+            if error is None and status not in transport.retry_status:
+                resp_vp=json.loads(body)
+                if self.print_job:
+                    print(resp_vp)
+                return resp_vp
+            if attempt>=transport.retries or not transport.retryable(method,status,sent):
+                if error is not None:
+                    raise error
+                return json.loads(body)
+            await asyncio.sleep(transport._wait(attempt,status,headers))
+            attempt+=1
+
+    async def _get_accessToken(self):
+        AccessToken=self.tokens.valid()
+        if AccessToken is None:
+            #renew in a thread, the token manager is shared with threads
+            loop=asyncio.get_running_loop()
+            AccessToken=await loop.run_in_executor(None,self.tokens.get)
+        return AccessToken
+
+    async def _run_sync(self,func,*args,**kwargs):
+        '''
+        Run a blocking method of the synchronous class in a thread, so that
+        catalog file reads and requests do not stall the event loop
+        '''
+        loop=asyncio.get_running_loop()
+        return await loop.run_in_executor(None,functools.partial(func,*args,**kwargs))
+
+    async def getAvailData(self,cube_code,time_range='2009-01-01,2018-12-31',
+                           location=[],season=[],stage=[]):
+        '''
+        See __WaPOR_API_class.getAvailData, dimension members are requested
+        concurrently
+        '''
+        try:
+            cube_info=await self._run_sync(self.api.getCubeInfo,cube_code)
+            dimensions=cube_info['dimension']
+        except:
+            print('ERROR: Cannot get cube info')
+            return None
+        try:
+            codes=[dims['code'] for dims in dimensions if dims['type'] in ['TIME','WHAT']]
+            tables=await asyncio.gather(*[self._query_dimensionsMembers(cube_code,code)
+                                          for code in codes])
+            members=dict(zip(codes,tables))
+            query_load,rows_codes,time_dims_code=self.api._availDataQuery(cube_code,cube_info,
+                                                                      members,time_range,
+                                                                      location,season,stage)
+            df=await self._query_availData(query_load)
+            if self.api._staleMembers(df,rows_codes,time_dims_code,members[time_dims_code]):
+                #a raster was published after the members were cached, refresh them once
+                self.members_cache.pop((self.version,cube_code,time_dims_code),None)
+                members[time_dims_code]=await self._query_dimensionsMembers(cube_code,
+                                                                            time_dims_code)
+        except:
+            print('ERROR:Cannot get list of available data')
+            return None
+        return self.api._availDataTable(df,rows_codes,time_dims_code,members[time_dims_code])
+
+    async def _query_availData(self,query_load):
+        resp_vp=await self._query('POST',self.api.path_query,'query/MDAQuery_Table',
+                                  json=query_load)
+        return self.api._availDataItems(resp_vp)
+
+    async def _query_dimensionsMembers(self,cube_code,dims_code):
+        df=self.api._cachedMembers(cube_code,dims_code)
+        if df is not None:
+            return df
+        resp_vp=await self._query('GET',self.api._dimensionsMembersUrl(cube_code,dims_code),
+                                  'members')
+        return self.api._cacheMembers(cube_code,dims_code,self.api._dimensionsMembersTable(resp_vp))
+
+    async def _query_jobStatus(self,job_url):
+        resp=await self._query('GET',job_url,'jobs')
+        return self.api._jobStatus(resp)
+
+    async def _query_jobOutput(self,job_url):
+        '''
+        Poll a job until it is finished and return its output
+        '''
+        wait=self.poll_interval
+        while True:
+            status,output=await self._query_jobStatus(job_url)
+            if status!='RUNNING':
+                return output
+            await asyncio.sleep(wait)
+            wait=min(wait*self.poll_backoff,self.poll_max_interval)
+
+    async def _query_cropRaster(self,bbox,cube_code,time_code,rasterId,
+                                AccessToken,season=None,stage=None):
+        query_crop_raster=await self._run_sync(self.api._cropRasterQuery,bbox,cube_code,
+                                               time_code,rasterId,season=season,
+                                               stage=stage)
+        resp_vp=await self._query('POST',self.api.path_query,'query/CropRaster',
+                                  AccessToken,json=query_crop_raster)
+        return resp_vp['response']['links'][0]['href']
+
+    async def getCropRasterURL(self,bbox,cube_code,
+                               time_code,rasterId,APIToken=None,season=None,stage=None):
+        '''
+        bbox: list
+            latitude and longitude
+            [xmin,ymin,xmax,ymax]
+        '''
+        AccessToken=await self._get_accessToken()
+        try:
+            job_url=await self._query_cropRaster(bbox,cube_code,time_code,rasterId,
+                                                 AccessToken,season=season,stage=stage)
+            return await self._query_jobOutput(job_url)
+        except:
+            print('Error: Cannot get cropped raster URL')
+
+    async def iterCropRasterURL(self,bbox,jobs,rasterIds=None,max_pending=None):
+        '''
+        Async generator of (index, download_url) in the order the CropRaster
+        jobs complete, see __WaPOR_API_class.iterCropRasterURL
+        '''
+        if bbox and isinstance(bbox[0],(list,tuple)):
+            bboxes=list(bbox)
+        else:
+            bboxes=[bbox]*len(jobs)
+        if rasterIds is None:
+            rasterIds=['{0}_{1}'.format(job[0],i) for i,job in enumerate(jobs)]
+        pending=asyncio.Semaphore(max_pending or self.max_pending_jobs)
+        async def crop(i):
+            cube_code,time_code,season,stage=jobs[i]
+            async with pending:
+                return i,await self.getCropRasterURL(bboxes[i],cube_code,time_code,
+                                                     rasterIds[i],season=season,
+                                                     stage=stage)
+        tasks=[asyncio.ensure_future(crop(i)) for i in range(len(jobs))]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def getPixelTimeseries(self,pixelCoordinates,cube_code,
+                                 time_range="2009-01-01,2018-12-31"):
+        '''
+        pixelCoordinates: list
+            [37.95883206252312, 7.89534]
+        '''
+        query_pixeltimeseries=await self._run_sync(self.api._pixelTimeseriesQuery,
+                                                   pixelCoordinates,cube_code,time_range)
+        resp_vp=await self._query('POST',self.api.path_query,'query/PixelTimeSeries',
+                                  json=query_pixeltimeseries)
+        return self.api._timeseriesTable(resp_vp)
+
+    async def getAreaTimeseries(self,shapefile_fh,cube_code,APIToken=None,
+                                time_range="2009-01-01,2018-12-31"):
+        '''
+        shapefile_fh: str, ogr Layer or GeoDataFrame
+                    "E:/Area.shp"
+        time_range: str
+                    "YYYY-MM-DD,YYYY-MM-DD"
+
+        Same table and area_cache as __WaPOR_API_class.getAreaTimeseries,
+        the jobs of up to max_pending_jobs features run at once.
+        '''
+        shapes=await self._run_sync(self.api._featureShapes,shapefile_fh)
+        keys=[self.api._areaKey(shape,cube_code,time_range) for _,shape in shapes]
+        todo=[i for i,key in enumerate(keys) if key not in self.area_cache]
+        pending=asyncio.Semaphore(self.max_pending_jobs)
+        async def area(i):
+            async with pending:
+                try:
+                    AccessToken=await self._get_accessToken()
+                    query_areatimeseries=await self._run_sync(self.api._areaTimeseriesQuery,
+                                                              shapes[i][1],cube_code,time_range)
+                    resp_query=await self._query('POST',self.api.path_query,'query/AreaStatsTimeSeries',
+                                                 AccessToken,json=query_areatimeseries)
+                    job_url=resp_query['response']['links'][0]['href']
+                except:
+                    print('Error: Cannot get server response of feature {0}'.format(shapes[i][0]))
+                    return
+                try:
+                    output=await self._query_jobOutput(job_url)
+                except:
+                    output=None
+            if output is None:
+                print('Error: Cannot get job output of feature {0}'.format(shapes[i][0]))
+            else:
+                self.area_cache[keys[i]]=output
+        await asyncio.gather(*[area(i) for i in todo])
+        return self.api._areaTable(shapes,keys)
+
+    async def downloadRaster(self,download_url,fh,chunk_size=1024*1024):
+        '''
+        Stream a raster from download_url into file fh, returns the number
+        of bytes written
+        '''
+        await self.open()
+        start=time.perf_counter()
+        size=0
+        async with self.session.get(download_url) as resp:
+            resp.raise_for_status()
+            with open(fh,'wb') as out:
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    out.write(chunk)
+                    size+=len(chunk)
+        self.transport._count('raster',time.perf_counter()-start)
+        return size
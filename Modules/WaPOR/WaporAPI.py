@@ -6,36 +6,87 @@ Contact: b.tran@un-ihe.org
 
 
 """
-import requests
+import hashlib
 import json
 import pandas as pd
 import datetime
 import pickle
 import os
+import threading
+import time
+from .transport import Transport
+from .access_token import TokenManager
+
+_catalogs={} #catalog table and cube index per catalog file, loaded once per process
+_catalogs_lock=threading.Lock()
 
 class __WaPOR_API_class(object):
-    def __init__(self,APIToken):    
-        self.path_catalog=r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/'
-        self.path_sign_in=r'https://io.apps.fao.org/gismgr/api/v1/iam/sign-in/'
-        self.path_refresh=r'https://io.apps.fao.org/gismgr/api/v1/iam/token'
-        self.path_download=r'https://io.apps.fao.org/gismgr/api/v1/download/'
-        self.path_query=r'https://io.apps.fao.org/gismgr/api/v1/query/'
-        self.path_jobs=r'https://io.apps.fao.org/gismgr/api/v1/catalog/workspaces/WAPOR/jobs/'
+    def __init__(self,APIToken,pool_size=16,timeout=(10,300),retries=5,
+                 base_url=r'https://io.apps.fao.org/gismgr/api/v1/'):    
+        '''
+        APIToken: str
+            WaPOR API token
+        pool_size: int
+            number of keep-alive connections to the WaPOR server
+        timeout: float or tuple
+            (connect, read) timeout in seconds of every request
+        retries: int
+            number of retries of a request after a connection error,
+            timeout or 429/5xx answer, POST requests only if they did not
+            reach the server or got a 429/503 answer
+        base_url: str
+            root url of the gismgr API, ending with '/'
+
+        No request is sent before the first call that needs one, the access
+        token is requested on the first authenticated call.
+        '''
+        self._setup(APIToken,pool_size,timeout,retries,base_url)
+
+    def _setup(self,APIToken,pool_size,timeout,retries,base_url):
+        self._set_paths(base_url)
         self.workspaces={2: 'WAPOR_2'}
         self.version=2    
         self.cached_catalog={2: os.path.join(os.path.dirname(__file__),'catalog_2.pkl')}
         self.APIToken=APIToken
         self.print_job=False #True to print all requests responses                    
-        self.AccessToken=self._query_accessToken()        
+        self.poll_interval=1 #seconds between job status requests, grows while jobs are running
+        self.poll_max_interval=30
+        self.poll_backoff=1.5
+        self.max_pending_jobs=16 #CropRaster jobs queued on the server at once
+        self.members_cache={} #dimension members per (version, cube, dimension)
+        self.members_ttl=3600 #seconds dimension members are reused
+        self.area_cache={} #area time series per (geometry hash, version, cube, time range)
+        self.transport=Transport(pool_size=pool_size,timeout=timeout,retries=retries)
+        self.tokens=TokenManager(self._query_accessToken,self._query_refreshToken)
+
+    @property
+    def AccessToken(self):
+        return self.tokens.AccessToken
+
+    def _set_paths(self,base_url):
+        self.path_catalog=r'{0}catalog/workspaces/'.format(base_url)
+        self.path_sign_in=r'{0}iam/sign-in/'.format(base_url)
+        self.path_refresh=r'{0}iam/token'.format(base_url)
+        self.path_download=r'{0}download/'.format(base_url)
+        self.path_query=r'{0}query/'.format(base_url)
+        self.path_jobs=r'{0}catalog/workspaces/WAPOR/jobs/'.format(base_url)
+
     def getCatalog(self,level=None,cubeInfo=True,cached=True):
         '''
         Get catalog from workspace
+
+        The catalog is loaded once per process and shared by all API
+        objects, cached=False loads a new catalog from the server.
         '''         
         catalog_pickle=self.cached_catalog[self.version]
         if cached:
-            print('Loading WaPOR catalog from cached file: {0}'.format(catalog_pickle))            
-            with open(catalog_pickle, 'rb') as handle: #read cached catalog
-                self.catalog=pickle.load(handle)        
+            with _catalogs_lock:
+                if catalog_pickle not in _catalogs:
+                    print('Loading WaPOR catalog from cached file: {0}'.format(catalog_pickle))            
+                    with open(catalog_pickle, 'rb') as handle: #read cached catalog
+                        _catalogs[catalog_pickle]=self._catalogIndex(pickle.load(handle))
+                    print('Cached WaPOR catalog has been loaded.\nIf you wish to update catalog from WaPOR server, run this line:\nWaPOR.API.getCatalog(cached=False)')
+                self.catalog=_catalogs[catalog_pickle][0]
         else:
             try:
                 df=self._query_catalog(level)
@@ -54,15 +105,23 @@ class __WaPOR_API_class(object):
             self.catalog=df
             with open(catalog_pickle, 'wb') as handle: #cache new catalog
                 pickle.dump(df,handle,protocol=pickle.HIGHEST_PROTOCOL) 
-        print('Cached WaPOR catalog has been loaded.\nIf you wish to update catalog from WaPOR server, run this line:\nWaPOR.API.getCatalog(cached=False)')
+            with _catalogs_lock:
+                _catalogs[catalog_pickle]=self._catalogIndex(df)
+            print('Cached WaPOR catalog has been loaded.\nIf you wish to update catalog from WaPOR server, run this line:\nWaPOR.API.getCatalog(cached=False)')
         return self.catalog            
+
+    def _catalogIndex(self,df):
+        '''
+        Catalog table and a dict of its records by cube code
+        '''
+        return df,{record['code']:record for record in df.to_dict('records')}
             
     def _query_catalog(self,level):
         if level == None:
             request_url = r'{0}{1}/cubes?overview=false&paged=false'.format(self.path_catalog,self.workspaces[self.version])
         else:
             request_url = r'{0}{1}/cubes?overview=false&paged=false&tags=L{2}'.format(self.path_catalog,self.workspaces[self.version],level)
-        resp = requests.get(request_url)
+        resp = self.transport.get(request_url,endpoint='cubes')
         resp_vp = resp.json()
         if self.print_job:
             print(resp_vp)        
@@ -88,25 +147,28 @@ class __WaPOR_API_class(object):
         '''
         Get cube info
         '''
-        try: 
-            catalog=self.catalog
-            if 'measure' not in catalog.columns:
-                catalog=self.getCatalog(cubeInfo=True)
-        except:
-            catalog=self.getCatalog(cubeInfo=True)         
+        catalog_pickle=self.cached_catalog[self.version]
         try:
-            cube_info=catalog.loc[catalog['code']==cube_code].to_dict('records')[0]         
-            return cube_info
+            if catalog_pickle not in _catalogs:
+                self.getCatalog(cubeInfo=True)
+            cube_info=_catalogs[catalog_pickle][1][cube_code]
         except:
             print('ERROR: Data for specified cube code and version is not available')
+            return None
+        if not isinstance(cube_info.get('measure'),dict):
+            #catalog loaded without cube info, query it once for this cube
+            cube_info['measure']=self._query_cubeMeasures(cube_code,version=self.version)
+            cube_info['dimension']=self._query_cubeDimensions(cube_code,version=self.version)
+        return cube_info
     
     def _query_cubeMeasures(self,cube_code,version=1):
         request_url = r'{0}{1}/cubes/{2}/measures?overview=false&paged=false'.format(self.path_catalog,
                         self.workspaces[self.version],cube_code)
-        resp = requests.get(request_url)
+        resp = self.transport.get(request_url,endpoint='measures')
         resp_vp=resp.json()
         if self.print_job:
             print(resp_vp)
+        cube_measures=None
         try:
             cube_measures = resp_vp['response'][0]
         except:
@@ -116,10 +178,11 @@ class __WaPOR_API_class(object):
     def _query_cubeDimensions(self,cube_code,version=1):
         request_url = r'{0}{1}/cubes/{2}/dimensions?overview=false&paged=false'.format(self.path_catalog,
                         self.workspaces[self.version],cube_code)
-        resp = requests.get(request_url)
+        resp = self.transport.get(request_url,endpoint='dimensions')
         resp_vp=resp.json()
         if self.print_job:
             print(resp_vp)
+        cube_dimensions=None
         try:
             cube_dimensions = resp_vp['response']
         except:
@@ -127,32 +190,18 @@ class __WaPOR_API_class(object):
         return cube_dimensions
     
     def _query_accessToken(self):
-        resp_vp=requests.post(self.path_sign_in,headers={'X-GISMGR-API-KEY':self.APIToken})
+        resp_vp=self.transport.post(self.path_sign_in,endpoint='sign-in',headers={'X-GISMGR-API-KEY':self.APIToken})
         resp_vp = resp_vp.json()
         if self.print_job:
             print(resp_vp)        
-        try:
-            self.AccessToken=resp_vp['response']['accessToken']
-            self.RefreshToken=resp_vp['response']['refreshToken']        
-            self.time_expire=resp_vp['response']['expiresIn']-600 #set expire time 2 minutes earlier
-            self.time_start=datetime.datetime.now().timestamp()
-        except:
-            print('\n ERROR:', resp_vp['message'])                      
-        return self.AccessToken
-            
-    
+        return resp_vp
+
     def _query_refreshToken(self,RefreshToken):
-        resp_vp=requests.post(self.path_refresh,json={'grandType':'refresh_token','refreshToken':RefreshToken})
+        resp_vp=self.transport.post(self.path_refresh,endpoint='token',json={'grandType':'refresh_token','refreshToken':RefreshToken})
         resp_vp = resp_vp.json()
         if self.print_job:
             print(resp_vp)
-        try:
-            self.AccessToken=resp_vp['response']['accessToken']            
-            self.time_start=datetime.datetime.now().timestamp()
-            self.time_expire=resp_vp['response']['expiresIn']-600
-        except:
-            print('\n ERROR:', resp_vp['message'])           
-        return self.AccessToken
+        return resp_vp
 
     def getAvailData(self,cube_code,time_range='2009-01-01,2018-12-31',
                      location=[],season=[],stage=[]):
@@ -173,73 +222,74 @@ class __WaPOR_API_class(object):
         '''
         try:
             cube_info=self.getCubeInfo(cube_code)
-            #get measures    
-            measure_code=cube_info['measure']['code']
             #get dimension
             dimensions=cube_info['dimension']
         except:
             print('ERROR: Cannot get cube info')
-            
-        dims_ls=[]
-        columns_codes=['MEASURES']
-        rows_codes=[]
+            return None
         try:
+            members={}
             for dims in dimensions:
-                if dims['type']=='TIME': #get time dims
-                    time_dims_code=dims['code']
-                    df_time=self._query_dimensionsMembers(cube_code,time_dims_code)
-                    time_dims= {
-                        "code": time_dims_code,
-                        "range": '[{0})'.format(time_range)
-                        }
-                    dims_ls.append(time_dims)
-                    rows_codes.append(time_dims_code)
-                if dims['type']=='WHAT':
-                    dims_code=dims['code']
-                    df_dims=self._query_dimensionsMembers(cube_code,dims_code) 
-                    members_ls=[row['code'] for i,row in df_dims.iterrows()]
-                    if (dims_code=='COUNTRY' or dims_code=='BASIN'):
-                        if location:
-                            members_ls=location
-                    if (dims_code=='SEASON'):
-                        if season:
-                            members_ls=season
-                    if (dims_code=='STAGE'):
-                        if stage:
-                            members_ls=stage    
-                         
-                    what_dims={
-                            "code":dims['code'],
-                            "values":members_ls
-                            }
-                    dims_ls.append(what_dims)
-                    rows_codes.append(dims['code']) 
-    
-            df=self._query_availData(cube_code,measure_code,
-                             dims_ls,columns_codes,rows_codes)
+                if dims['type'] in ['TIME','WHAT']:
+                    members[dims['code']]=self._query_dimensionsMembers(cube_code,dims['code'])
+            query_load,rows_codes,time_dims_code=self._availDataQuery(cube_code,cube_info,
+                                                                      members,time_range,
+                                                                      location,season,stage)
+            df=self._query_availData(query_load)
+            if self._staleMembers(df,rows_codes,time_dims_code,members[time_dims_code]):
+                #a raster was published after the members were cached, refresh them once
+                self.members_cache.pop((self.version,cube_code,time_dims_code),None)
+                members[time_dims_code]=self._query_dimensionsMembers(cube_code,time_dims_code)
         except:
             print('ERROR:Cannot get list of available data')
             return None
-        #sorted df
-        keys=rows_codes+ ['raster_id','bbox','time_code']
-        df_dict = { i : [] for i in keys }
-        for irow,row in df.iterrows():
-            for i in range(len(row)):
-                if row[i]['type']=='ROW_HEADER':
-                    key_info=row[i]['value']
-                    df_dict[keys[i]].append(key_info)
-                    if keys[i]==time_dims_code:
-                        time_info=df_time.loc[df_time['caption']==key_info].to_dict(orient='records')
-                        df_dict['time_code'].append(time_info[0]['code'])
-                if row[i]['type']=='DATA_CELL':
-                    raster_info=row[i]['metadata']['raster']
-            df_dict['raster_id'].append(raster_info['id'])
-            df_dict['bbox'].append(raster_info['bbox'])                    
-        df_sorted=pd.DataFrame.from_dict(df_dict)
-        return df_sorted            
-    
-    def _query_availData(self,cube_code,measure_code,
-                         dims_ls,columns_codes,rows_codes):                
+        return self._availDataTable(df,rows_codes,time_dims_code,members[time_dims_code])
+
+    def _availDataQuery(self,cube_code,cube_info,members,time_range,
+                        location=[],season=[],stage=[]):
+        '''
+        Build the MDAQuery_Table payload of getAvailData
+
+        members: dict
+            DataFrame of dimension members per TIME and WHAT dimension code
+
+        Returns the payload, the row dimension codes and the time dimension code
+        '''
+        #get measures    
+        measure_code=cube_info['measure']['code']
+        dims_ls=[]
+        columns_codes=['MEASURES']
+        rows_codes=[]
+        time_dims_code=None
+        for dims in cube_info['dimension']:
+            if dims['type']=='TIME': #get time dims
+                time_dims_code=dims['code']
+                time_dims= {
+                    "code": time_dims_code,
+                    "range": '[{0})'.format(time_range)
+                    }
+                dims_ls.append(time_dims)
+                rows_codes.append(time_dims_code)
+            if dims['type']=='WHAT':
+                dims_code=dims['code']
+                df_dims=members[dims_code]
+                members_ls=list(df_dims['code'])
+                if (dims_code=='COUNTRY' or dims_code=='BASIN'):
+                    if location:
+                        members_ls=location
+                if (dims_code=='SEASON'):
+                    if season:
+                        members_ls=season
+                if (dims_code=='STAGE'):
+                    if stage:
+                        members_ls=stage    
+                     
+                what_dims={
+                        "code":dims['code'],
+                        "values":members_ls
+                        }
+                dims_ls.append(what_dims)
+                rows_codes.append(dims['code']) 
         query_load={
           "type": "MDAQuery_Table",              
           "params": {
@@ -260,11 +310,45 @@ class __WaPOR_API_class(object):
             }
           }
         }
-            
-        resp = requests.post(self.path_query, json=query_load)
+        return query_load,rows_codes,time_dims_code
+
+    def _availDataTable(self,df,rows_codes,time_dims_code,df_time):
+        '''
+        Sort the MDAQuery_Table items of getAvailData into a table with
+        one row per raster
+        '''
+        keys=rows_codes+ ['raster_id','bbox','time_code']
+        if df.empty:
+            return pd.DataFrame(columns=keys)
+        #row headers come first, the raster is in the (last) data cell
+        df_dict={code:[cell['value'] for cell in df[i]] for i,code in enumerate(rows_codes)}
+        raster_info=[cell['metadata']['raster'] for cell in df[df.columns[-1]]]
+        df_dict['raster_id']=[raster['id'] for raster in raster_info]
+        df_dict['bbox']=[raster['bbox'] for raster in raster_info]
+        time_codes=dict(zip(df_time['caption'][::-1],df_time['code'][::-1])) #first match wins
+        df_dict['time_code']=[time_codes[caption] for caption in df_dict[time_dims_code]]
+        df_sorted=pd.DataFrame.from_dict(df_dict)
+        return df_sorted            
+    
+    def _staleMembers(self,df,rows_codes,time_dims_code,df_time):
+        '''
+        True if a time caption of the MDAQuery_Table items is not in the
+        cached time members
+        '''
+        if df.empty:
+            return False
+        captions=set(df_time['caption'])
+        return any(cell['value'] not in captions for cell in df[rows_codes.index(time_dims_code)])
+
+    def _query_availData(self,query_load):
+        resp = self.transport.post(self.path_query,endpoint='query/MDAQuery_Table',json=query_load)
         resp_vp = resp.json()
         if self.print_job:
             print(resp_vp) 
+        return self._availDataItems(resp_vp)
+
+    def _availDataItems(self,resp_vp):
+        results=[]
         try:
             results=resp_vp['response']['items']              
         except:
@@ -272,16 +356,40 @@ class __WaPOR_API_class(object):
         return pd.DataFrame(results)
             
     def _query_dimensionsMembers(self,cube_code,dims_code):
-        base_url='{0}{1}/cubes/{2}/dimensions/{3}/members?overview=false&paged=false'       
-        request_url=base_url.format(self.path_catalog,
-                                    self.workspaces[self.version],
-                                    cube_code,
-                                    dims_code
-                                    )
-        resp = requests.get(request_url)
+        df=self._cachedMembers(cube_code,dims_code)
+        if df is not None:
+            return df
+        request_url=self._dimensionsMembersUrl(cube_code,dims_code)
+        resp = self.transport.get(request_url,endpoint='members')
         resp_vp = resp.json()
         if self.print_job:
             print(resp_vp)
+        return self._cacheMembers(cube_code,dims_code,self._dimensionsMembersTable(resp_vp))
+
+    def _cachedMembers(self,cube_code,dims_code):
+        '''
+        Dimension members of an earlier request younger than members_ttl, or None
+        '''
+        cached=self.members_cache.get((self.version,cube_code,dims_code))
+        if cached is None or time.time()-cached[0]>self.members_ttl:
+            return None
+        return cached[1]
+
+    def _cacheMembers(self,cube_code,dims_code,df):
+        if df is not None:
+            self.members_cache[(self.version,cube_code,dims_code)]=(time.time(),df)
+        return df
+
+    def _dimensionsMembersUrl(self,cube_code,dims_code):
+        base_url='{0}{1}/cubes/{2}/dimensions/{3}/members?overview=false&paged=false'       
+        return base_url.format(self.path_catalog,
+                               self.workspaces[self.version],
+                               cube_code,
+                               dims_code
+                               )
+
+    def _dimensionsMembersTable(self,resp_vp):
+        df=None
         try:
             avail_items=resp_vp['response']
             df=pd.DataFrame.from_dict(avail_items, orient='columns')            
@@ -321,10 +429,11 @@ class __WaPOR_API_class(object):
                   ]
                }        
             }                
-        resp = requests.post(self.path_query, json=query_location)
+        resp = self.transport.post(self.path_query,endpoint='query/TableQuery_GetList_1',json=query_location)
         resp_vp = resp.json()
         if self.print_job:
             print(resp_vp)        
+        df_loc=None
         try:
             avail_items=resp_vp['response']
             df_loc = pd.DataFrame.from_dict(avail_items, orient='columns')
@@ -339,13 +448,7 @@ class __WaPOR_API_class(object):
     
     def getRasterUrl(self,cube_code,rasterId,APIToken):
         #Get AccessToken              
-        try:
-            AccessToken=self.AccessToken    
-            self.time_now=datetime.datetime.now().timestamp()
-            if self.time_now-self.time_start > self.time_expire:
-                AccessToken=self._query_refreshToken(self.RefreshToken)                
-        except:
-            AccessToken=self._query_accessToken(self.APIToken)            
+        AccessToken=self._get_accessToken()
         download_url=self._query_rasterUrl(cube_code,rasterId,AccessToken)
         return download_url
         
@@ -353,15 +456,15 @@ class __WaPOR_API_class(object):
         base_url='{0}{1}'.format(self.path_download,
                   self.workspaces[self.version])
         
-        headers_val={'Authorization': "Bearer " + AccessToken}
         params_val={'language':'en', 'requestType':'mapset_raster', 
                 'cubeCode':cube_code, 'rasterId':rasterId}
         
-        resp_vp=requests.get(base_url,headers=headers_val,
-                             params=params_val)
+        resp_vp=self._authorized('GET',base_url,'download',AccessToken,
+                                 params=params_val)
         resp_vp = resp_vp.json()
         if self.print_job:
             print(resp_vp)
+        download_url=None
         try:
             resp=resp_vp['response']
             expiry_date = datetime.datetime.now() + datetime.timedelta(seconds=int(resp['expiresIn']))
@@ -372,44 +475,126 @@ class __WaPOR_API_class(object):
                 
     def _query_jobOutput(self,job_url):
         '''
-                 
-                    
-        '''
-        contiue=True        
-        while contiue:        
-            resp = requests.get(job_url)
-            resp=resp.json()
-            if self.print_job:
-                print(resp)
-            jobType=resp['response']['type']            
-            if resp['response']['status']=='COMPLETED':
-                contiue=False
-                if jobType == 'CROP RASTER':
-                    output=resp['response']['output']['downloadUrl']                
-                elif jobType == 'AREA STATS':
-                    results=resp['response']['output']
-                    output=pd.DataFrame(results['items'],columns=results['header'])
-                else:
-                    print('ERROR: Invalid jobType')                
+        Poll a job until it is finished and return its output.
+        The wait between polls grows from poll_interval to poll_max_interval.
+        '''
+        wait=self.poll_interval
+        while True:
+            status,output=self._query_jobStatus(job_url)
+            if status!='RUNNING':
                 return output
-            if resp['response']['status']=='COMPLETED WITH ERRORS':
-                contiue=False
-                print(resp['response']['log'])                
-                
-    def getCropRasterURL(self,bbox,cube_code,
-                          time_code,rasterId,APIToken,season=None,stage=None):
+            time.sleep(wait)
+            wait=min(wait*self.poll_backoff,self.poll_max_interval)
+
+    def _query_jobStatus(self,job_url):
         '''
-        bbox: str
-            latitude and longitude
-            [xmin,ymin,xmax,ymax]
+        Get the status of a job once
+
+        Returns
+        -------
+        status : str
+            'COMPLETED', 'FAILED' or 'RUNNING'
+        output : str or DataFrame
+            download url (CROP RASTER) or table (AREA STATS) of a completed job
+        '''
+        resp = self.transport.get(job_url,endpoint='jobs')
+        resp=resp.json()
+        if self.print_job:
+            print(resp)
+        return self._jobStatus(resp)
+
+    def _jobStatus(self,resp):
+        jobType=resp['response']['type']
+        if resp['response']['status']=='COMPLETED':
+            output=None
+            if jobType == 'CROP RASTER':
+                output=resp['response']['output']['downloadUrl']
+            elif jobType == 'AREA STATS':
+                results=resp['response']['output']
+                output=pd.DataFrame(results['items'],columns=results['header'])
+            else:
+                print('ERROR: Invalid jobType')
+            return 'COMPLETED',output
+        if resp['response']['status']=='COMPLETED WITH ERRORS':
+            print(resp['response']['log'])
+            return 'FAILED',None
+        return 'RUNNING',None
+
+    def _query_jobOutputs(self,job_urls,max_pending=None):
+        '''
+        Poll a list of jobs together and yield (index, output) as jobs finish.
+
+        job_urls: iterable of (index, job_url)
+            consumed lazily, so that jobs can be submitted while earlier jobs
+            are polled. A job_url of None yields (index, None) right away.
+        max_pending: int
+            maximum number of jobs waited on at once, default max_pending_jobs
+
+        A failed job yields None as output. The wait between polling rounds is
+        reset to poll_interval when a job finished and grows otherwise.
+        '''
+        if max_pending is None:
+            max_pending=self.max_pending_jobs
+        job_urls=iter(job_urls)
+        pending={}
+        exhausted=False
+        wait=self.poll_interval
+        while True:
+            while not exhausted and len(pending)<max_pending:
+                try:
+                    i,job_url=next(job_urls)
+                except StopIteration:
+                    exhausted=True
+                    break
+                if job_url is None:
+                    yield i,None
+                else:
+                    pending[i]=job_url
+            if not pending:
+                break
+            finished=False
+            for i in list(pending):
+                try:
+                    status,output=self._query_jobStatus(pending[i])
+                except Exception as e:
+                    print('ERROR: Cannot get job status. {0}'.format(e))
+                    status,output='FAILED',None
+                if status!='RUNNING':
+                    del pending[i]
+                    finished=True
+                    yield i,output
+            if not pending:
+                if exhausted:
+                    break
+                continue
+            if finished:
+                wait=self.poll_interval
+            else:
+                wait=min(wait*self.poll_backoff,self.poll_max_interval)
+            time.sleep(wait)
+
+    def _query_cropRaster(self,bbox,cube_code,time_code,rasterId,
+                          AccessToken,season=None,stage=None):
+        '''
+        Submit a CropRaster job and return the job url
+        '''
+        query_crop_raster=self._cropRasterQuery(bbox,cube_code,time_code,
+                                                rasterId,season=season,stage=stage)
+        resp_vp=self._authorized('POST',self.path_query,'query/CropRaster',AccessToken,
+                                 json=query_crop_raster)
+        resp_vp = resp_vp.json()
+        if self.print_job:
+            print(resp_vp)
+        job_url=resp_vp['response']['links'][0]['href']
+        if self.print_job:
+            print('Getting download url from: {0}'.format(job_url))
+        return job_url
+
+    def _cropRasterQuery(self,bbox,cube_code,time_code,rasterId,
+                         season=None,stage=None):
+        '''
+        Build the CropRaster payload of one raster
         '''
-        #Get AccessToken        
-        AccessToken=self.AccessToken        
-        self.time_now=datetime.datetime.now().timestamp()
-        #print("\n Use Current AccessToken, start: {0}, elapsed time: {1}".format(self.time_start,self.time_now-self.time_start))            
-        if self.time_now-self.time_start > self.time_expire:
-            AccessToken=self._query_refreshToken(self.RefreshToken)
-            #print("\n Refresh AccessToken")                
         #Create Polygon        
         xmin,ymin,xmax,ymax=bbox[0],bbox[1],bbox[2],bbox[3]
         Polygon=[
@@ -482,45 +667,185 @@ class __WaPOR_API_class(object):
             }
           }
         }
-        resp_vp=requests.post(self.path_query,
-                              headers={'Authorization':'Bearer {0}'.format(AccessToken)},
-                                                       json=query_crop_raster)
-        resp_vp = resp_vp.json()
-        if self.print_job:
-            print(resp_vp)
+        return query_crop_raster
+
+    def _get_accessToken(self):
+        return self.tokens.get()
+
+    def _authorized(self,method,url,endpoint,AccessToken=None,**kwargs):
+        '''
+        Send a request with the access token. When the server rejects the
+        token with 401, it is renewed and the request is sent once more.
+        '''
+        if AccessToken is None:
+            AccessToken=self._get_accessToken()
+        headers=kwargs.pop('headers',{})
+        for attempt in range(2):
+            resp=self.transport.request(method,url,endpoint=endpoint,
+                                        headers=dict(headers,Authorization='Bearer {0}'.format(AccessToken)),
+                                        **kwargs)
+            if resp.status_code!=401 or attempt>0:
+                return resp
+            #revoked on the server before it expired
+            self.tokens.invalidate(AccessToken)
+            AccessToken=self._get_accessToken()
+                
+    def getCropRasterURL(self,bbox,cube_code,
+                          time_code,rasterId,APIToken,season=None,stage=None):
+        '''
+        bbox: str
+            latitude and longitude
+            [xmin,ymin,xmax,ymax]
+        '''
+        #Get AccessToken        
+        AccessToken=self._get_accessToken()
         try:
-            job_url=resp_vp['response']['links'][0]['href']
-            if self.print_job:
-                print('Getting download url from: {0}'.format(job_url))
+            job_url=self._query_cropRaster(bbox,cube_code,time_code,rasterId,
+                                           AccessToken,season=season,stage=stage)
             download_url=self._query_jobOutput(job_url)
             return download_url     
         except:
             print('Error: Cannot get cropped raster URL')
 
-    def getAreaTimeseries(self,shapefile_fh,cube_code,APIToken,
-                          time_range="2009-01-01,2018-12-31"):
+    def iterCropRasterURL(self,bbox,jobs,rasterIds=None,max_pending=None):
         '''
-        shapefile_fh: str
+        Submit a list of CropRaster jobs and poll them together.
+        Yields (index, download_url) in the order the jobs complete, so the
+        first rasters can be transferred while other jobs are still queued.
+        download_url is None for a job that could not be submitted or failed.
+
+        bbox: list
+            [xmin,ymin,xmax,ymax] for all jobs, or one bbox per job
+        jobs: list of tuples
+            (cube_code, time_code, season, stage), season and stage can be None
+        rasterIds: list of str
+            raster id per job, used as output file name on the server
+        max_pending: int
+            maximum number of jobs queued on the server at once, default
+            max_pending_jobs
+        '''
+        if bbox and isinstance(bbox[0],(list,tuple)):
+            bboxes=list(bbox)
+        else:
+            bboxes=[bbox]*len(jobs)
+        if rasterIds is None:
+            rasterIds=['{0}_{1}'.format(job[0],i) for i,job in enumerate(jobs)]
+        def submit():
+            for i,(cube_code,time_code,season,stage) in enumerate(jobs):
+                try:
+                    AccessToken=self._get_accessToken()
+                    job_url=self._query_cropRaster(bboxes[i],cube_code,time_code,
+                                                   rasterIds[i],AccessToken,
+                                                   season=season,stage=stage)
+                except:
+                    print('Error: Cannot get cropped raster URL')
+                    job_url=None
+                yield i,job_url
+        yield from self._query_jobOutputs(submit(),max_pending=max_pending)
+
+    def getAreaTimeseries(self,shapefile_fh,cube_code,APIToken=None,
+                          time_range="2009-01-01,2018-12-31",max_workers=8):
+        '''
+        shapefile_fh: str, ogr Layer or GeoDataFrame
                     "E:/Area.shp"
         time_range: str
                     "YYYY-MM-DD,YYYY-MM-DD"
+        max_workers: int
+            number of AreaStatsTimeSeries jobs submitted at once
+
+        Returns one table for all features with a feature_id column, the FID
+        of the feature in the layer or the index of the GeoDataFrame.
+        Tables are kept per (geometry, cube_code, time_range), features
+        that were queried before are not sent again.
         '''
-        #Get AccessToken        
-        try:
-            AccessToken=self.AccessToken
-            self.time_now=datetime.datetime.now().timestamp()            
-            if self.time_now-self.time_start > self.time_expire:
-                AccessToken=self._query_refreshToken(self.RefreshToken)                
-        except:
-            AccessToken=self._query_accessToken(self.APIToken)
+        from concurrent.futures import ThreadPoolExecutor
         #get shapefile info
-        import ogr
+        shapes=self._featureShapes(shapefile_fh)
+        keys=[self._areaKey(shape,cube_code,time_range) for _,shape in shapes]
+        todo=[i for i,key in enumerate(keys) if key not in self.area_cache]
+        def submit(i):
+            try:
+                query_areatimeseries=self._areaTimeseriesQuery(shapes[i][1],cube_code,time_range)
+                resp_query=self._authorized('POST',self.path_query,'query/AreaStatsTimeSeries',
+                                            json=query_areatimeseries)
+                resp_query = resp_query.json()
+                if self.print_job:
+                    print(resp_query)
+                return resp_query['response']['links'][0]['href']
+            except:
+                print('Error: Cannot get server response of feature {0}'.format(shapes[i][0]))
+                return None
+        if todo:
+            #submit the jobs of all features, then poll them together
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                job_urls=zip(todo,executor.map(submit,todo))
+                for i,output in self._query_jobOutputs(job_urls):
+                    if output is None:
+                        print('Error: Cannot get job output of feature {0}'.format(shapes[i][0]))
+                    else:
+                        self.area_cache[keys[i]]=output
+        return self._areaTable(shapes,keys)
+
+    def _areaTable(self,shapes,keys):
+        '''
+        Cached tables of the features in one table with a feature_id column
+        '''
+        tables=[]
+        for (feature_id,_),key in zip(shapes,keys):
+            if key in self.area_cache:
+                df=self.area_cache[key].copy()
+                df.insert(0,'feature_id',feature_id)
+                tables.append(df)
+        if not tables:
+            return None
+        return pd.concat(tables,ignore_index=True)
+
+    def _areaKey(self,shape,cube_code,time_range):
+        geometry=json.dumps(shape,sort_keys=True)
+        return (hashlib.sha256(geometry.encode('utf-8')).hexdigest(),
+                self.version,cube_code,time_range)
+
+    def _featureShapes(self,features):
+        '''
+        (feature id, query shape) of all features of a shapefile, ogr Layer
+        or GeoDataFrame
+        '''
+        if hasattr(features,'geometry') and hasattr(features,'crs'): #GeoDataFrame
+            name='EPSG:{0}'.format(features.crs.to_epsg())
+            return [(feature_id,dict(geometry.__geo_interface__,properties={'name':name}))
+                    for feature_id,geometry in features.geometry.items()
+                    if geometry is not None]
+        from osgeo import ogr
+        if isinstance(features,str):
+            dts=ogr.Open(features)
+            layer=dts.GetLayer()
+        else:
+            layer=features
+        epsg_code=layer.GetSpatialRef().GetAuthorityCode(None)
+        shapes=[]
+        layer.ResetReading()
+        for feature in layer:
+            shape=feature.ExportToJson(as_object=True)['geometry']
+            shape["properties"]={"name": "EPSG:{0}".format(epsg_code)}
+            shapes.append((feature.GetFID(),shape))
+        return shapes
+
+    def _shapefileShape(self,shapefile_fh):
+        '''
+        Geometry of the first feature of a shapefile as query shape
+        '''
+        from osgeo import ogr
         dts=ogr.Open(shapefile_fh)
         layer=dts.GetLayer()
         epsg_code=layer.GetSpatialRef().GetAuthorityCode(None)
         shape=layer.GetFeature(0).ExportToJson(as_object=True)['geometry']
         shape["properties"]={"name": "EPSG:{0}".format(epsg_code)}
-        
+        return shape
+
+    def _areaTimeseriesQuery(self,shape,cube_code,time_range):
+        '''
+        Build the AreaStatsTimeSeries payload of one shape
+        '''
         #get cube info
         cube_info=self.getCubeInfo(cube_code)
         cube_measure_code=cube_info['measure']['code']
@@ -549,26 +874,7 @@ class __WaPOR_API_class(object):
             "shape": shape
           }
         }
-        
-        resp_query=requests.post(self.path_query,
-                                 headers={'Authorization':'Bearer {0}'.format(AccessToken)},
-                                          json=query_areatimeseries)
-        resp_query = resp_query.json()
-        if self.print_job:
-            print(resp_query)
-        try:
-            job_url=resp_query['response']['links'][0]['href'] 
-        except:
-            print('Error: Cannot get server response')
-            return None
-        try:
-            print('Getting result from: {0}'.format(job_url))
-            output=self._query_jobOutput(job_url)     
-            return output
-        except:
-            print('Error: Cannot get job output')
-            return None
-
+        return query_areatimeseries
             
     def getPixelTimeseries(self,pixelCoordinates,cube_code,
                            time_range="2009-01-01,2018-12-31"):
@@ -576,6 +882,139 @@ class __WaPOR_API_class(object):
         pixelCoordinates: list
             [37.95883206252312, 7.89534]
         '''
+        query_pixeltimeseries=self._pixelTimeseriesQuery(pixelCoordinates,
+                                                         cube_code,time_range)
+        #requests
+        resp_query=self.transport.post(self.path_query,endpoint='query/PixelTimeSeries',
+                                       json=query_pixeltimeseries)
+        resp_vp=resp_query.json()
+        if self.print_job:
+            print(resp_vp)             
+        return self._timeseriesTable(resp_vp)
+
+    def getPixelTimeseriesBatch(self,points,cube_code,
+                                time_range="2009-01-01,2018-12-31",
+                                Dir=None,max_workers=8):
+        '''
+        Time series of many points in one long table with columns
+        point_id, x, y, time, value and source
+
+        points: array_like
+            [[x,y],...] in latitude and longitude, point_id is the row number
+        Dir: str
+            output directory of a download_* module for cube_code, ex.
+            'Data/WAPOR.v2_dekadal_L2_AETI_D'. For points inside its rasters
+            the time steps of getAvailData that its manifest lists as finished
+            for cube_code are read from the rasters (source 'local'), all
+            other points and time steps are queried from the server (source
+            'remote')
+        max_workers: int
+            number of remote PixelTimeSeries queries sent at once
+
+        time is the time_code of the step, as in getAvailData. value is in
+        the unit of PixelTimeSeries: local values are divided by the number
+        of days the download module multiplied them with. Local rasters of
+        download modules with clip_negative have no negative values.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        import numpy as np
+        points=np.asarray(points,dtype=np.float64).reshape(-1,2)
+        tables=[]
+        remote={point_id:None for point_id in range(len(points))}
+        if Dir is not None:
+            local,remote=self._localPixelTimeseries(points,Dir,cube_code,time_range)
+            tables.append(local)
+        def query(item):
+            point_id,steps=item
+            x,y=points[point_id]
+            try:
+                df=self.getPixelTimeseries([x,y],cube_code,time_range=time_range)
+            except Exception as e:
+                print('ERROR: Cannot get time series of point {0}. {1}'.format(point_id,e))
+                df=None
+            if df is None:
+                return None
+            df=pd.DataFrame({'point_id':point_id,'x':x,'y':y,
+                             'time':self._timeCodes(cube_code,df[df.columns[0]].values),
+                             'value':df[df.columns[-1]].values,
+                             'source':'remote'})
+            if steps is not None:
+                df=df[df['time'].isin(steps)]
+            return df
+        if remote:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                tables+=[df for df in executor.map(query,remote.items()) if df is not None]
+        if not tables:
+            return pd.DataFrame(columns=['point_id','x','y','time','value','source'])
+        return pd.concat(tables,ignore_index=True).sort_values(['point_id','time'],
+                                                              kind='stable',
+                                                              ignore_index=True)
+
+    def _localPixelTimeseries(self,points,Dir,cube_code,time_range):
+        '''
+        Long table of the points inside the local rasters of Dir, and per
+        other point the time codes to query from the server, None for all.
+        A raster is local if the manifest of Dir lists it as finished for
+        cube_code, the time step and the bbox of the first local raster.
+        '''
+        import numpy as np
+        from . import GIS_functions as gis
+        from .manifest import open_manifest
+        df_avail=self.getAvailData(cube_code,time_range=time_range)
+        if df_avail is None:
+            df_avail=pd.DataFrame(columns=['raster_id','time_code'])
+        entries=open_manifest(Dir).entries
+        steps=[]
+        missing=[]
+        for raster_id,time_code in zip(df_avail['raster_id'],df_avail['time_code']):
+            entry=entries.get(raster_id,{})
+            fh=os.path.join(Dir,entry.get('file','{0}.tif'.format(raster_id)))
+            if (entry.get('status')=='complete' and entry.get('cube_code')==cube_code
+                and entry.get('time_code')==time_code and 'ndays' in entry
+                and entry['bbox']==(steps[0][3] if steps else entry['bbox'])
+                and os.path.exists(fh)):
+                steps.append((time_code,fh,entry['ndays'],entry['bbox']))
+            else:
+                missing.append(time_code)
+        fhs=[fh for _,fh,_,_ in steps]
+        values,inside=gis.SamplePoints(fhs,points[:,0],points[:,1])
+        #back to the daily values of PixelTimeSeries
+        ndays=np.array([1 if n is None else n for _,_,n,_ in steps],dtype=np.float64)
+        values=values/ndays.reshape(-1,1)
+        point_ids=np.flatnonzero(inside)
+        if not fhs:
+            point_ids=point_ids[:0]
+        #one row per (time step, point), stacked time steps first
+        local=pd.DataFrame({'point_id':np.tile(point_ids,len(fhs)),
+                            'x':np.tile(points[point_ids,0],len(fhs)),
+                            'y':np.tile(points[point_ids,1],len(fhs)),
+                            'time':np.repeat([time_code for time_code,_,_,_ in steps],len(point_ids)),
+                            'value':values[:,point_ids].ravel(),
+                            'source':'local'})
+        remote={point_id:None for point_id in np.setdiff1d(np.arange(len(points)),point_ids)}
+        if missing:
+            remote.update({point_id:missing for point_id in point_ids})
+        return local,dict(sorted(remote.items()))
+
+    def _timeCodes(self,cube_code,captions):
+        '''
+        Time codes of the time captions of a time series table, the time
+        members are requested again once when a caption is not among them
+        '''
+        cube_info=self.getCubeInfo(cube_code)
+        time_dims_code=[dims['code'] for dims in cube_info['dimension'] if dims['type']=='TIME'][0]
+        for attempt in range(2):
+            df_time=self._query_dimensionsMembers(cube_code,time_dims_code)
+            time_codes=dict(zip(df_time['caption'][::-1],df_time['code'][::-1])) #first match wins
+            if attempt>0 or all(caption in time_codes for caption in captions):
+                break
+            self.members_cache.pop((self.version,cube_code,time_dims_code),None)
+        return [time_codes.get(caption,caption) for caption in captions]
+
+    def _pixelTimeseriesQuery(self,pixelCoordinates,cube_code,time_range):
+        '''
+        Build the PixelTimeSeries payload of one point
+        '''
         #get cube info
         cube_info=self.getCubeInfo(cube_code)
         cube_measure_code=cube_info['measure']['code']
@@ -608,12 +1047,10 @@ class __WaPOR_API_class(object):
                 }
               }
             }
-               
-        #requests
-        resp_query=requests.post(self.path_query,json=query_pixeltimeseries)
-        resp_vp=resp_query.json()
-        if self.print_job:
-            print(resp_vp)             
+        return query_pixeltimeseries
+
+    def _timeseriesTable(self,resp_vp):
+        df=None
         try:
             results=resp_vp['response']
             df=pd.DataFrame(results['items'],columns=results['header'])                
@@ -7,7 +7,7 @@ Repository: https://github.com/wateraccounting/watools
 Module: Collect/WaPOR
 
 Description:
-This script collects WaPOR data from the WaPOR API. 
+This script collects WaPOR data from the WaPOR API.
 The data is available between 2009-01-01 till present.
 
 Example:
@@ -16,37 +16,87 @@ WaPOR.PCP_dekadal(Dir='C:/Temp/', Startdate='2009-02-24', Enddate='2009-03-09',
                      latlim=[50,54], lonlim=[3,7])
 WaPOR.AETI_dekadal(Dir='C:/Temp/', Startdate='2009-02-24', Enddate='2009-03-09',
                      latlim=[50,54], lonlim=[3,7])
+
+API, APIToken and the download functions are created on first use, so
+importing the package sends no request and does not ask for the token. The
+token is read from the WAPOR_API_TOKEN environment variable, or from
+wapor_api_token.pkl (asked once and saved there when it does not exist).
+
+WaPOR.download_dekadal and the other download_* names are the main functions
+of their submodules, also after the submodule itself was imported, e.g. by
+`from WaPOR.download_dekadal import download_jobs`.
 """
-import pickle
+import importlib
 import os
-from .WaporAPI import __WaPOR_API_class
-from .download_dekadal import main as download_dekadal
-from .download_monthly import main as download_monthly
-from .download_yearly import main as download_yearly
-from .download_daily import main as download_daily
-from .download_seasonal import main as download_seasonal
-
-__all__ = ['download_dekadal','download_monthly','download_yearly','download_daily']
+import sys
+import threading
+import types
+
+__all__ = ['download_dekadal','download_monthly','download_yearly','download_daily',
+           'download_batch']
 __doc__ = """module for FAO WAPOR API"""
 __version__ = '0.1'
 
-# initiate class for .his-files
-
 api_token_pickle=os.path.join(os.path.dirname(__file__),
                               'wapor_api_token.pkl')
 
-if not os.path.exists(api_token_pickle):
-    wapor_api_token=input('Insert WAPOR API Token: ')
-    with open(api_token_pickle, 'wb') as handle:
-        pickle.dump(wapor_api_token, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        print("Saved API Token")    
-else:
-    with open(api_token_pickle, 'rb') as handle:
-        wapor_api_token=pickle.load(handle)
-        print("Obtained saved API Token")
-print("Your WaPOR API Token is saved into: {0}. \n If you wish to change your API Token, please delete this file".format(api_token_pickle))       
-APIToken=wapor_api_token
-API = __WaPOR_API_class(APIToken)
+_download_modules=['download_dekadal','download_monthly','download_yearly',
+                   'download_daily','download_seasonal','download_batch']
+_api_lock=threading.Lock()
+
+
+def _load_token():
+    import pickle
+    if 'WAPOR_API_TOKEN' in os.environ:
+        return os.environ['WAPOR_API_TOKEN']
+    if not os.path.exists(api_token_pickle):
+        wapor_api_token=input('Insert WAPOR API Token: ')
+        with open(api_token_pickle, 'wb') as handle:
+            pickle.dump(wapor_api_token, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            print("Saved API Token")
+    else:
+        with open(api_token_pickle, 'rb') as handle:
+            wapor_api_token=pickle.load(handle)
+            print("Obtained saved API Token")
+    print("Your WaPOR API Token is saved into: {0}. \n If you wish to change your API Token, please delete this file".format(api_token_pickle))
+    return wapor_api_token
+
+
+def _load_api():
+    # initiate class for .his-files
+    from .WaporAPI import __WaPOR_API_class
+    with _api_lock:
+        if 'API' not in globals():
+            APIToken=_load_token()
+            globals()['APIToken']=APIToken
+            globals()['API']=__WaPOR_API_class(APIToken)
+    return globals()['API']
+
+
+def __getattr__(name):
+    if name in ('API','APIToken'):
+        _load_api()
+        return globals()[name]
+    if name in _download_modules:
+        importlib.import_module('.{0}'.format(name),__name__)
+        return globals()[name]
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__,name))
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # the import system binds every imported submodule to the package,
+        # keep the main function under the download_* names instead
+        if name in _download_modules and isinstance(value,types.ModuleType):
+            value=value.main
+        super().__setattr__(name,value)
+
+
+sys.modules[__name__].__class__=_Package
+
+
+def __dir__():
+    return sorted(list(globals())+['API','APIToken']+_download_modules)
 
 # load catalog
-#API.getCatalog()
\ No newline at end of file
+#API.getCatalog()
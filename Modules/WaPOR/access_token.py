@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Access token of the WaPOR API shared by threads and async tasks.
+
+TokenManager signs in on first use and renews the access token a margin
+before it expires, with the refresh token or, when that fails, a new sign-in.
+A lock makes sure that only one renewal is in flight: the other threads wait
+for it and then use the new token instead of sending their own request. When
+the sign-in fails, the waiting threads get no token instead of each signing
+in again, until retry_wait seconds have passed. A token the server rejects is
+invalidated by the API class and renewed on the next get.
+"""
+import threading
+import time
+
+
+class TokenManager(object):
+    def __init__(self, sign_in, refresh, margin=600, retry_wait=30):
+        '''
+        sign_in: callable
+            sends the sign-in request and returns its json response
+        refresh: callable
+            sends the refresh request of a refresh token and returns its
+            json response
+        margin: float
+            seconds before expiry at which the access token is renewed
+        retry_wait: float
+            seconds after a failed sign-in in which no new sign-in is sent
+        '''
+        self.sign_in=sign_in
+        self.refresh=refresh
+        self.margin=margin
+        self.retry_wait=retry_wait
+        self.RefreshToken=None
+        self.renewals=0
+        self._state=(None,0.0) #access token and time it must be renewed
+        self._retry_at=0.0 #time before which a failed sign-in is not repeated
+        self._lock=threading.Lock()
+
+    @property
+    def AccessToken(self):
+        return self._state[0]
+
+    def valid(self):
+        '''
+        Current access token, or None if it must be renewed first
+        '''
+        AccessToken,renew_at=self._state
+        if AccessToken is not None and time.time()<renew_at:
+            return AccessToken
+        return None
+
+    def get(self):
+        '''
+        Access token, signing in or refreshing it when needed. None if the
+        sign-in failed less than retry_wait seconds ago.
+        '''
+        AccessToken=self.valid()
+        if AccessToken is not None:
+            return AccessToken
+        with self._lock:
+            #another thread may have renewed the token while this one waited
+            AccessToken=self.valid()
+            if AccessToken is None and time.time()>=self._retry_at:
+                AccessToken=self._renew()
+        return AccessToken
+
+    def invalidate(self, AccessToken):
+        '''
+        Renew AccessToken on the next get, e.g. after the server rejected it
+        '''
+        with self._lock:
+            if self._state[0]==AccessToken:
+                self._state=(AccessToken,0.0)
+
+    def _renew(self):
+        if self.RefreshToken is not None:
+            try:
+                resp_vp=self.refresh(self.RefreshToken)
+            except Exception:
+                #network error or no json answer, sign in instead
+                resp_vp=None
+            if self._set(resp_vp):
+                return self.AccessToken
+            #refresh token has expired as well, sign in again
+        try:
+            resp_vp=self.sign_in()
+        except Exception:
+            self._retry_at=time.time()+self.retry_wait
+            raise
+        if not self._set(resp_vp):
+            print('\n ERROR:', resp_vp.get('message'))
+            self._retry_at=time.time()+self.retry_wait
+            return None
+        return self.AccessToken
+
+    def _set(self, resp_vp):
+        try:
+            response=resp_vp['response']
+            AccessToken=response['accessToken']
+            renew_at=time.time()+response['expiresIn']-self.margin
+        except (KeyError,TypeError):
+            return False
+        self.RefreshToken=response.get('refreshToken',self.RefreshToken)
+        self._state=(AccessToken,renew_at)
+        self._retry_at=0.0
+        self.renewals+=1
+        return True
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the download path against the local stand-in server.
+
+Every scenario starts a StandInServer, points WaPOR.API to it and downloads
+the dekadal rasters of a period with download_dekadal.download_jobs and
+download_pool.run into a temporary directory, in serial (one raster at a
+time) or concurrent mode and for a small or large bbox. Reported per
+scenario:
+- rasters per second and MB per second of raster data over the download
+- seconds per stage: catalog load, getAvailData, the download as a whole and
+  its stages from the run's Progress: job wait (CropRaster submit to
+  download url), raster transfer, GDAL correction (post-scaling) and write.
+  The download stages are summed over the worker threads, so they can add
+  up to more than the wall time of a concurrent run.
+- HTTP requests per raster, in total and per endpoint
+
+The results are written as JSON, to compare releases run the benchmark with
+the same arguments.
+
+Example:
+from WaPOR import benchmark
+benchmark.main('wapor_benchmark.json', latency=0.05, job_delay=1)
+"""
+import datetime
+import json
+import platform
+import shutil
+import tempfile
+import time
+
+import WaPOR
+from WaPOR import download_pool
+from WaPOR.progress import Progress
+from WaPOR.download_dekadal import download_jobs
+from WaPOR import WaporAPI
+from WaPOR.standin import StandInServer
+
+MODES={'serial':1,'concurrent':8} #max_workers of download_pool.run
+BBOXES={'small':0.1,'large':1.0} #width and height in degrees
+
+
+def main(output='wapor_benchmark.json', Startdate='2009-01-01',
+         Enddate='2009-02-28', modes=MODES, bboxes=BBOXES, center=(38.5,7.5),
+         level=2, latency=0.02, job_delay=0.5, poll_interval=0.1, **kwargs):
+    """
+    Run all combinations of modes and bboxes and write the results to output
+
+    Keyword arguments:
+    output -- JSON file the results are written to
+    Startdate -- 'yyyy-mm-dd'
+    Enddate -- 'yyyy-mm-dd'
+    modes -- dict of mode name and max_workers
+    bboxes -- dict of bbox name and its size in degrees
+    center -- [lon, lat] center of the bboxes
+    level -- WaPOR level of the AETI cube (1 or 2)
+    latency -- seconds the server waits before every answer
+    job_delay -- seconds a CropRaster job runs on the server
+    poll_interval -- seconds between job status requests of the API
+    kwargs -- other settings of StandInServer, e.g. bandwidth or failure_rate
+    """
+    settings=dict(kwargs,latency=latency,job_delay=job_delay)
+    results={'version':WaPOR.__version__,
+             'python':platform.python_version(),
+             'date':datetime.datetime.now().isoformat(timespec='seconds'),
+             'period':[Startdate,Enddate],
+             'level':level,
+             'server':settings,
+             'poll_interval':poll_interval,
+             'scenarios':[]}
+    for mode,max_workers in modes.items():
+        for name,size in bboxes.items():
+            bbox=[center[0]-size/2,center[1]-size/2,center[0]+size/2,center[1]+size/2]
+            print('Benchmark {0} {1}'.format(mode,name))
+            scenario=run_scenario(bbox,max_workers,Startdate,Enddate,level,
+                                  poll_interval,settings)
+            scenario.update(mode=mode,bbox_name=name)
+            results['scenarios'].append(scenario)
+    with open(output,'w') as f:
+        json.dump(results,f,indent=2)
+    return results
+
+
+def run_scenario(bbox, max_workers, Startdate, Enddate, level=2,
+                 poll_interval=0.1, settings={}):
+    '''
+    Download the AETI rasters of one bbox with max_workers and return the
+    measurements
+    '''
+    timer=Progress(name='benchmark')
+    Dir=tempfile.mkdtemp(prefix='wapor_benchmark_')
+    try:
+        with StandInServer(**settings) as server, server.install() as API:
+            API.poll_interval=poll_interval
+            with timer.stage('catalog'):
+                with WaporAPI._catalogs_lock:
+                    WaporAPI._catalogs.pop(API.cached_catalog[API.version],None) #measure a cold catalog load
+                API.getCatalog(cached=True)
+            with timer.stage('avail'):
+                resolved=download_jobs(Dir,data='AETI',Startdate=Startdate,Enddate=Enddate,
+                                   latlim=[bbox[1],bbox[3]],lonlim=[bbox[0],bbox[2]],
+                                   level=level)
+            if resolved is None:
+                raise RuntimeError('Cannot resolve the rasters of the benchmark')
+            jobs=resolved[1]
+            avail_requests=_requests(API.transport.report())
+            bar=Progress(name='download')
+            start=time.perf_counter()
+            failed=download_pool.run(jobs,max_workers=max_workers,Waitbar=bar)
+            seconds=time.perf_counter()-start
+            report=API.transport.report()
+    finally:
+        shutil.rmtree(Dir,ignore_errors=True)
+    stages={stage:stats['seconds'] for stage,stats in timer.snapshot()['stages'].items()}
+    stages['download']=seconds
+    snapshot=bar.snapshot()
+    stages.update({stage:stats['seconds'] for stage,stats in snapshot['stages'].items()})
+    nbytes=snapshot['bytes']
+    rasters=len(jobs)-len(failed)
+    requests=_requests(report)
+    download_requests={endpoint:count-avail_requests.get(endpoint,0)
+                       for endpoint,count in requests.items()
+                       if count>avail_requests.get(endpoint,0)}
+    return {'bbox':bbox,
+            'max_workers':max_workers,
+            'rasters':rasters,
+            'failed':len(failed),
+            'bytes':nbytes,
+            'seconds':seconds,
+            'rasters_per_s':rasters/seconds if seconds else None,
+            'mb_per_s':nbytes/1e6/seconds if seconds else None,
+            'stages':stages,
+            'requests_per_raster':sum(download_requests.values())/rasters if rasters else None,
+            'requests':download_requests,
+            'transport':report}
+
+
+def _requests(report):
+    return {endpoint:stats['requests'] for endpoint,stats in report.items()}
+
+
+if __name__=='__main__':
+    import sys
+    main(*sys.argv[1:2])
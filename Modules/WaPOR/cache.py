@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Local raster cache shared by projects and regions of interest.
+
+Corrected rasters of the download_* modules are stored once under a key of
+(version, cube_code, raster_id, bbox). A later download of the same raster,
+in any output directory, is materialized from the cache as a hardlink (or a
+copy across file systems) without touching the network. The cache is capped
+in size and evicts the least recently used rasters first.
+
+The cache lives in cache_dir, default the WAPOR_CACHE_DIR environment
+variable or ~/.cache/wapor. It keeps no index: the files are the entries and
+their modification time is the last use, so several processes can share it.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+
+def default_cache_dir():
+    return os.environ.get('WAPOR_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'),'.cache','wapor'))
+
+
+class RasterCache(object):
+    def __init__(self, cache_dir=None, max_size=20*1024**3):
+        '''
+        cache_dir: str
+            directory of the cache, default from default_cache_dir
+        max_size: int
+            maximum size of the cache in bytes, default 20 GB
+        '''
+        self.cache_dir=cache_dir if cache_dir is not None else default_cache_dir()
+        self.max_size=max_size
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+        self._lock=threading.Lock()
+        self._size=None
+
+    def key(self, version, cube_code, raster_id, bbox, variant=None):
+        '''
+        Key of a raster, a sha256 hex digest of its identity
+
+        variant: str
+            name of a different encoding of the same raster, ex. 'compact'
+        '''
+        identity=[version,cube_code,raster_id,[float(v) for v in bbox]]
+        if variant is not None:
+            identity.append(variant)
+        identity=json.dumps(identity)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir,key[:2],'{0}.tif'.format(key))
+
+    def get(self, key, outfilename):
+        '''
+        Materialize the cached raster of key as outfilename.
+        Returns True on a hit, False if key is not in the cache.
+        '''
+        path=self._path(key)
+        try:
+            os.utime(path) #mark as recently used
+        except OSError:
+            with self._lock:
+                self.misses+=1
+            return False
+        if os.path.exists(outfilename):
+            os.remove(outfilename)
+        try:
+            os.link(path,outfilename)
+        except OSError:
+            shutil.copyfile(path,outfilename)
+        with self._lock:
+            self.hits+=1
+        return True
+
+    def put(self, key, fh):
+        '''
+        Store file fh under key and evict old rasters above max_size
+        '''
+        path=self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        #copy under a unique name first, so other processes never see half a raster
+        tmp='{0}.{1}.tmp'.format(path,uuid.uuid4().hex)
+        try:
+            os.link(fh,tmp)
+        except OSError:
+            shutil.copyfile(fh,tmp)
+        os.replace(tmp,path)
+        with self._lock:
+            if self._size is None:
+                self._size=sum(size for _,size,_ in self._entries())
+            else:
+                self._size+=os.path.getsize(path)
+            if self._size>self.max_size:
+                self._evict()
+
+    def _entries(self):
+        entries=[]
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for sub in os.listdir(self.cache_dir):
+            folder=os.path.join(self.cache_dir,sub)
+            if not os.path.isdir(folder):
+                continue
+            for fn in os.listdir(folder):
+                if fn.endswith('.tif'):
+                    stat=os.stat(os.path.join(folder,fn))
+                    entries.append((os.path.join(folder,fn),stat.st_size,stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        #rescan, other processes may have added or removed rasters
+        entries=sorted(self._entries(),key=lambda entry: entry[2])
+        self._size=sum(size for _,size,_ in entries)
+        for path,size,_ in entries:
+            if self._size<=self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size-=size
+            self.evictions+=1
+
+    def stats(self):
+        '''
+        Hits, misses and evictions of this process, and size and number of
+        rasters of the cache
+        '''
+        entries=self._entries()
+        with self._lock:
+            requests=self.hits+self.misses
+            return {'hits':self.hits,
+                    'misses':self.misses,
+                    'hit_rate':self.hits/requests if requests else 0.0,
+                    'evictions':self.evictions,
+                    'rasters':len(entries),
+                    'size':sum(size for _,size,_ in entries)}
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Download several WaPOR variables of one area and period at once.
+
+The cubes and available rasters of all variables are resolved up front, then
+the rasters of all variables go through one download_pool.run. The rasters
+are interleaved so that every variable progresses at the same rate, and the
+pool stays busy until the largest variable is done instead of waiting for
+each variable in turn.
+
+Example:
+import WaPOR
+WaPOR.download_batch(output_dir,[('RET','dekadal',1),('PCP','dekadal',1),
+                                 ('AETI','dekadal',2),('T','dekadal',2),
+                                 ('NPP','dekadal',2),('LCC','yearly',2)],
+                     Startdate='2014-11-01',Enddate='2015-03-15',
+                     latlim=[ymin-0.1,ymax+0.1],lonlim=[xmin-0.1,xmax+0.1])
+"""
+import WaPOR
+import importlib
+from WaPOR import download_pool
+from concurrent.futures import ThreadPoolExecutor
+
+RESOLUTIONS=['daily','dekadal','monthly','yearly','seasonal']
+
+
+def main(Dir, specs, Startdate='2009-01-01', Enddate='2018-12-31',
+         latlim=[-40.05, 40.05], lonlim=[-30.5, 65.05],
+         version = 2, Waitbar = 1,cached_catalog=True,max_workers=None,cache=None,
+         tile_size=None,mosaic='vrt',compact=False):
+    """
+    This function downloads several WaPOR variables
+
+    Keyword arguments:
+    Dir -- 'C:/file/to/path/'
+    specs -- list of (data, temporal resolution, level), ex. ('AETI','dekadal',2)
+             temporal resolution is 'daily', 'dekadal', 'monthly', 'yearly' or 'seasonal'
+    Startdate -- 'yyyy-mm-dd'
+    Enddate -- 'yyyy-mm-dd'
+    latlim -- [ymin, ymax] (values must be between -40.05 and 40.05)
+    lonlim -- [xmin, xmax] (values must be between -30.05 and 65.05)
+    cached_catalog -- True  Use a cached catalog. False Load a new catalog from the database
+    max_workers -- number of rasters downloaded at once, default None sizes the pool from the CPU count so that the variables download together. 1 downloads one by one
+    cache -- RasterCache (or its directory) to share rasters between projects, None to not use a cache
+    tile_size -- None to download each raster at once, or size in degrees of tiles that are downloaded separately
+    mosaic -- 'vrt' to write the tiles of each raster as a VRT, 'tif' to merge them into one GeoTIFF
+    compact -- True to keep the integer values of WaPOR and store the multiplier as scale metadata, read back by OpenAsArray
+
+    Returns a dict with the output directory of each spec, None for specs
+    that cannot be found
+    """
+    specs=[tuple(spec) for spec in specs]
+    print(f'\nDownload WaPOR {len(specs)} variables for the period {Startdate} till {Enddate}')
+
+    # Load the catalog once for all variables
+    WaPOR.API.version=version
+    WaPOR.API.getCatalog(cached=cached_catalog)
+
+    def resolve(spec):
+        data,resolution,level=spec
+        if resolution not in RESOLUTIONS:
+            print('ERROR: Invalid temporal resolution %s'%(resolution))
+            return None
+        module=importlib.import_module('WaPOR.download_{0}'.format(resolution))
+        try:
+            return module.download_jobs(Dir,data=data,Startdate=Startdate,Enddate=Enddate,
+                                        latlim=latlim,lonlim=lonlim,level=level,
+                                        version=version,cached_catalog=True,
+                                        compact=compact)
+        except Exception as e:
+            print('ERROR: Cannot get list of available {0} {1} data. {2}'.format(resolution,data,e))
+            return None
+
+    # Level 3 specs ask for a cube code, resolve them here one by one
+    resolved={spec:resolve(spec) for spec in specs if spec[2]==3}
+    remote=[spec for spec in specs if spec[2]!=3]
+    if remote:
+        with ThreadPoolExecutor(max_workers=min(len(remote),8)) as executor:
+            resolved.update(zip(remote,executor.map(resolve,remote)))
+
+    job_lists=[]
+    for spec in specs:
+        if resolved[spec] is not None:
+            print('{0} {1} level {2}: {3} rasters'.format(spec[1],spec[0],spec[2],
+                                                          len(resolved[spec][1])))
+            job_lists.append(resolved[spec][1])
+    if tile_size is None:
+        download_pool.run(interleave(job_lists),max_workers=max_workers,
+                          Waitbar=Waitbar,cache=cache)
+    else:
+        download_pool.run_tiled(interleave(job_lists),tile_size,mosaic=mosaic,
+                                max_workers=max_workers,Waitbar=Waitbar,cache=cache)
+    return {spec:(resolved[spec][0] if resolved[spec] is not None else None)
+            for spec in specs}
+
+
+def interleave(job_lists):
+    '''
+    Merge lists of jobs so that each list is spread evenly over the result,
+    the k-th job of a list of n jobs is scheduled at fraction k/n of the work
+    '''
+    order=[]
+    for i,jobs in enumerate(job_lists):
+        for k,job in enumerate(jobs):
+            order.append(((k+0.5)/len(jobs),i,job))
+    order.sort(key=lambda item: item[:2])
+    return [job for _,_,job in order]
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""
+Shared raster loop of the download_* modules.
+
+Each raster goes through a CropRaster job, a poll loop, a streamed HTTP
+transfer and a block-wise GDAL correction. run() executes these steps for a
+list of raster jobs, either one raster at a time (max_workers=1) or for many
+rasters at once in a bounded thread pool. Both paths write the same files and report errors the same way.
+run_tiled() splits large extents into tiles on the WaPOR pixel grid and
+mosaics them per raster.
+With a RasterCache, rasters downloaded before for another project or
+directory are linked from the cache instead of downloaded again.
+"""
+import WaPOR
+import os
+from WaPOR import GIS_functions as gis
+from WaPOR.manifest import open_manifest
+from WaPOR.cache import RasterCache
+from WaPOR import progress
+from osgeo import gdal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE=1024*1024 #bytes per read of a raster transfer
+VSIMEM_MAX=64*1024*1024 #larger transfers are streamed to a raw_*.tif file on disk
+PIXEL_SIZE={'L1':1/448.,'L2':1/1120.} #degrees, 250 m and 100 m grids
+#the level 1 and 2 grids have pixel corners on multiples of the pixel size,
+#ex. the level 1 continental raster starts at -30.0044643 = -13442/448 degrees
+GRID_ORIGIN=(0.,0.)
+
+
+def default_max_workers():
+    '''
+    Number of rasters processed at once when max_workers is None.
+    Rasters mostly wait on the server and the network, so use a few threads
+    more than there are cores, capped to stay polite to the WaPOR API.
+    '''
+    return min(16, (os.cpu_count() or 1) + 4)
+
+
+def new_job(row, bbox, cube_code, Dir, multiplier, ndays=None,
+            clip_negative=False, season=None, stage=None, compact=False):
+    '''
+    Describe the download of one row of WaPOR.API.getAvailData
+
+    row: pandas Series
+        row of df_avail with 'raster_id' and 'time_code'
+    ndays: float
+        number of days the raster values are multiplied with, None to skip
+    clip_negative: bool
+        set negative (flagged) values to 0 before correction
+    compact: bool
+        keep the integer values of the server and store multiplier and
+        ndays as scale metadata, see GIS_functions.ScaleGeoTiff
+    '''
+    return {'raster_id': row['raster_id'],
+            'time_code': row['time_code'],
+            'bbox': bbox,
+            'cube_code': cube_code,
+            'season': season,
+            'stage': stage,
+            'Dir': Dir,
+            'multiplier': multiplier,
+            'ndays': ndays,
+            'clip_negative': clip_negative,
+            'compact': compact}
+
+
+def download_raster(job, bar=None):
+    '''
+    Get the cropped raster of one job and write the corrected GeoTIFF
+
+    bar: Progress
+        receives the seconds of the job, transfer, scale and write stages
+        and the transferred bytes
+    '''
+    if bar is None:
+        bar=progress.Progress()
+    outfilename=resume_raster(job,bar)
+    if outfilename is not None:
+        return outfilename
+    ### get download url
+    with bar.stage('job'):
+        download_url=WaPOR.API.getCropRasterURL(job['bbox'],job['cube_code'],
+                                               job['time_code'],
+                                               job['raster_id'],
+                                               WaPOR.API.APIToken,
+                                               season=job['season'],
+                                               stage=job['stage'])
+    return fetch_raster(job,download_url,bar)
+
+
+def fetch_raster(job, download_url, bar=None):
+    '''
+    Transfer the cropped raster of a completed job and write the corrected GeoTIFF
+    '''
+    if download_url is None:
+        raise RuntimeError('Cannot get cropped raster URL')
+    if bar is None:
+        bar=progress.Progress()
+    ### Download raster file in chunks
+    with bar.stage('transfer'):
+        resp=WaPOR.API.transport.get(download_url,endpoint='raster',stream=True)
+        resp.raise_for_status()
+        size=int(resp.headers.get('Content-Length',VSIMEM_MAX+1))
+        if size<=VSIMEM_MAX:
+            #small rasters are kept in GDAL's in-memory file system
+            download_file='/vsimem/raw_{0}.tif'.format(job['raster_id'])
+            fh=gdal.VSIFOpenL(download_file,'wb')
+            try:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    gdal.VSIFWriteL(chunk,1,len(chunk),fh)
+                    bar.add_bytes(len(chunk))
+            finally:
+                gdal.VSIFCloseL(fh)
+        else:
+            #large rasters go to disk, an interrupted transfer is resumed on the next run
+            download_file=_partfilename(job)
+            if 'Content-Length' in resp.headers:
+                open_manifest(job['Dir']).set_partial(job,download_url,size)
+            _write_stream(resp,download_file,'wb',bar)
+    return _correct_raster(job,download_file,bar)
+
+
+def resume_raster(job, bar=None):
+    '''
+    Finish the interrupted transfer of job recorded in the manifest with an
+    HTTP Range request. Returns the output file, or None if there is nothing
+    to resume or the server does not serve the rest of the file anymore.
+    '''
+    entry=open_manifest(job['Dir']).partial(job)
+    download_file=_partfilename(job)
+    if entry is None or not os.path.exists(download_file):
+        return None
+    if bar is None:
+        bar=progress.Progress()
+    offset=os.path.getsize(download_file)
+    if offset<entry['size']:
+        with bar.stage('transfer'):
+            try:
+                resp=WaPOR.API.transport.get(entry['url'],endpoint='raster',stream=True,
+                                             headers={'Range':'bytes={0}-'.format(offset)})
+            except Exception:
+                return None
+            if (resp.status_code==206 and
+                resp.headers.get('Content-Range','').startswith('bytes {0}-'.format(offset))):
+                _write_stream(resp,download_file,'ab',bar)
+            elif resp.status_code==200:
+                _write_stream(resp,download_file,'wb',bar)
+            else:
+                return None
+    if os.path.getsize(download_file)!=entry['size']:
+        os.remove(download_file)
+        return None
+    return _correct_raster(job,download_file,bar)
+
+
+def _outfilename(job):
+    return os.path.join(job['Dir'],'{0}.tif'.format(job['raster_id']))
+
+
+def _partfilename(job):
+    return os.path.join(job['Dir'],'{0}.tif.part'.format(job['raster_id']))
+
+
+def _write_stream(resp, download_file, mode, bar):
+    with open(download_file,mode) as fh:
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            fh.write(chunk)
+            bar.add_bytes(len(chunk))
+
+
+def _correct_raster(job, download_file, bar):
+    '''
+    Correct the transferred raster with multiplier (and number of days) block
+    by block, remove the transfer and record the output in the manifest
+    '''
+    outfilename=_outfilename(job)
+    if os.path.exists(outfilename):
+        #may be a hardlink into the raster cache, never overwrite it in place
+        os.remove(outfilename)
+    try:
+        with bar.stage('scale'):
+            gis.ScaleGeoTiff(download_file,outfilename,job['multiplier'],
+                             ndays=job['ndays'],clip_negative=job['clip_negative'],
+                             compact=job.get('compact',False))
+    finally:
+        if download_file.startswith('/vsimem/'):
+            gdal.Unlink(download_file)
+        else:
+            os.remove(download_file)
+    with bar.stage('write'):
+        open_manifest(job['Dir']).set_complete(job,outfilename)
+    return outfilename
+
+
+def _cache_key(cache, job):
+    return cache.key(WaPOR.API.version,job['cube_code'],job['raster_id'],job['bbox'],
+                     variant='compact' if job.get('compact') else None)
+
+
+def run(jobs, max_workers=1, Waitbar=1, max_pending=None, verify=False,
+        cache=None):
+    '''
+    Download a list of raster jobs made with new_job
+
+    max_workers: int
+        number of rasters processed at once, default 1 processes the rasters
+        one by one in the calling thread. None sizes the pool with
+        default_max_workers.
+    Waitbar: int, str, callable, list or Progress
+        1 to print a progress bar, see progress.progress for JSON lines logs,
+        callbacks and a Progress shared between runs. The Progress counts
+        rasters, bytes and errors and the seconds of the job, transfer, scale
+        and write stages.
+    max_pending: int
+        maximum number of CropRaster jobs queued on the server at once when
+        max_workers > 1, default WaPOR.API.max_pending_jobs
+    verify: bool
+        also compare the checksum of rasters finished by an earlier run
+    cache: RasterCache or str
+        local raster cache (or its directory) shared between output
+        directories, None to not use a cache
+
+    Returns the list of raster ids that failed. A failing raster is reported
+    and skipped, the other rasters are still downloaded.
+
+    Finished rasters are recorded in the manifest.json of their directory.
+    Rasters finished by an earlier run with the same time_code and bbox are
+    skipped, interrupted transfers are resumed.
+    '''
+    if max_workers is None:
+        max_workers=default_max_workers()
+    #skip rasters that were finished by an earlier run
+    todo=[job for job in jobs
+          if not open_manifest(job['Dir']).is_complete(job,_outfilename(job),verify=verify)]
+    if len(todo)<len(jobs):
+        print('{0} of {1} rasters were downloaded before'.format(len(jobs)-len(todo),len(jobs)))
+    jobs=todo
+    if isinstance(cache,str):
+        cache=RasterCache(cache)
+    if cache is not None:
+        #link rasters downloaded before for another directory or project
+        todo=[]
+        for job in jobs:
+            if cache.get(_cache_key(cache,job),_outfilename(job)):
+                open_manifest(job['Dir']).set_complete(job,_outfilename(job))
+            else:
+                todo.append(job)
+        if len(todo)<len(jobs):
+            print('{0} of {1} rasters were taken from the cache'.format(len(jobs)-len(todo),len(jobs)))
+        jobs=todo
+    failed=[]
+    bar=progress.progress(Waitbar,len(jobs))
+
+    def _done(job, error):
+        if error is not None:
+            print('\nERROR: Cannot download raster {0}. {1}'.format(job['raster_id'],error))
+            failed.append(job['raster_id'])
+        bar.item(job['raster_id'],error)
+
+    def _store(job, outfilename):
+        if cache is not None:
+            with bar.stage('write'):
+                cache.put(_cache_key(cache,job),outfilename)
+
+    try:
+        if max_workers <= 1:
+            for job in jobs:
+                try:
+                    _store(job,download_raster(job,bar))
+                    _done(job, None)
+                except Exception as e:
+                    _done(job, e)
+        else:
+            _run_pool(jobs,max_workers,max_pending,bar,_store,_done)
+    finally:
+        if bar is not Waitbar:
+            bar.close()
+    return failed
+
+
+def _run_pool(jobs, max_workers, max_pending, bar, _store, _done):
+    '''
+    CropRaster jobs are submitted and polled together from this thread,
+    transfers and corrections start in the pool as soon as a job completes
+    '''
+    lock=threading.Lock()
+    def _work(func, job, *args):
+        try:
+            _store(job,func(job,*args,bar))
+            error=None
+        except Exception as e:
+            error=e
+        with lock:
+            _done(job,error)
+    #interrupted transfers are resumed directly, without a new CropRaster job
+    resume=[job for job in jobs if open_manifest(job['Dir']).partial(job) is not None]
+    jobs=[job for job in jobs if open_manifest(job['Dir']).partial(job) is None]
+    submitted={}
+    def crop_jobs():
+        #iterCropRasterURL takes the next job just before submitting it
+        for i,job in enumerate(jobs):
+            submitted[i]=time.perf_counter()
+            yield (job['cube_code'],job['time_code'],job['season'],job['stage'])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for job in resume:
+            executor.submit(_work,download_raster,job)
+        if not jobs:
+            return
+        for i,download_url in WaPOR.API.iterCropRasterURL([job['bbox'] for job in jobs],
+                                                          crop_jobs(),
+                                                          rasterIds=[job['raster_id'] for job in jobs],
+                                                          max_pending=max_pending):
+            bar.add_stage('job',time.perf_counter()-submitted[i])
+            executor.submit(_work,fetch_raster,jobs[i],download_url)
+
+
+def pixel_size(cube_code):
+    '''
+    Pixel size in degrees of the WaPOR grid of a cube, None for level 3 cubes
+    that are in a local projection
+    '''
+    return PIXEL_SIZE.get(cube_code[:2])
+
+
+def tile_jobs(job, tile_size):
+    '''
+    Split the bbox of a job into tiles of about tile_size degrees. Inner tile
+    edges are snapped to the WaPOR pixel grid (GRID_ORIGIN and the pixel
+    size of the cube), so that neighbouring tiles share no pixels.
+    mosaic_tiles checks that the downloaded tiles are on one grid. Returns
+    the list of tile jobs, written to a 'tiles' folder in the directory of job.
+    '''
+    size=pixel_size(job['cube_code'])
+    xmin,ymin,xmax,ymax=job['bbox']
+    def edges(start,stop,origin):
+        n=max(1,int(round((stop-start)/tile_size)))
+        inner=[origin+round((start+k*(stop-start)/n-origin)/size)*size for k in range(1,n)]
+        return [start]+inner+[stop]
+    xs=edges(xmin,xmax,GRID_ORIGIN[0])
+    ys=edges(ymin,ymax,GRID_ORIGIN[1])
+    tiles=[]
+    for row in range(len(ys)-1):
+        for col in range(len(xs)-1):
+            tile=dict(job)
+            tile['raster_id']='{0}_{1}_{2}'.format(job['raster_id'],row,col)
+            tile['bbox']=[xs[col],ys[row],xs[col+1],ys[row+1]]
+            tile['Dir']=os.path.join(job['Dir'],'tiles')
+            tiles.append(tile)
+    return tiles
+
+
+def run_tiled(jobs, tile_size, mosaic='vrt', tile_retries=2, max_workers=None, **kwargs):
+    '''
+    Download a list of raster jobs as tiles of about tile_size degrees
+
+    tile_size: float
+        size of the tiles in degrees
+    mosaic: str
+        'vrt' to write a <raster_id>.vrt of the tiles of each raster, 'tif'
+        to merge them into <raster_id>.tif and remove the tiles. Both are
+        recorded in the manifest of the raster directory, glob '*.tif' and
+        '*.vrt' to find the rasters of a tiled download.
+    tile_retries: int
+        number of times the failed tiles are downloaded again
+    max_workers: int
+        number of tiles downloaded at once, default None sizes the pool
+        with default_max_workers
+    kwargs:
+        arguments of run
+
+    All tiles of all rasters go through run at once. Failed tiles are
+    retried on their own, a raster fails only if one of its tiles still
+    fails after tile_retries. Level 3 jobs are downloaded without tiling.
+    The runs and the mosaic stage report into one Progress, in which
+    retried tiles are counted once.
+    Returns the list of raster ids that failed.
+    '''
+    Waitbar=kwargs.pop('Waitbar',1)
+    bar=progress.progress(Waitbar,0)
+    try:
+        return _run_tiled(jobs,tile_size,mosaic,tile_retries,bar,
+                          max_workers=max_workers,**kwargs)
+    finally:
+        if bar is not Waitbar:
+            bar.close()
+
+
+def _run_tiled(jobs, tile_size, mosaic, tile_retries, bar, **kwargs):
+    whole=[job for job in jobs if pixel_size(job['cube_code']) is None]
+    parents=[job for job in jobs if pixel_size(job['cube_code']) is not None]
+    if mosaic=='tif':
+        #skip rasters that were merged by an earlier run
+        parents=[job for job in parents
+                 if not open_manifest(job['Dir']).is_complete(job,_outfilename(job))]
+    tiles={job['raster_id']:tile_jobs(job,tile_size) for job in parents}
+    for job in parents:
+        os.makedirs(os.path.join(job['Dir'],'tiles'),exist_ok=True)
+    todo=[tile for job in parents for tile in tiles[job['raster_id']]]+whole
+    failed=run(todo,Waitbar=bar,**kwargs)
+    for attempt in range(tile_retries):
+        if not failed:
+            break
+        print('Retry {0} failed tiles'.format(len(failed)))
+        bar.retry(len(failed))
+        failed=run([tile for tile in todo if tile['raster_id'] in failed],
+                   Waitbar=bar,**kwargs)
+    failed=set(failed)
+    failed_rasters=[job['raster_id'] for job in whole if job['raster_id'] in failed]
+    for job in parents:
+        if any(tile['raster_id'] in failed for tile in tiles[job['raster_id']]):
+            failed_rasters.append(job['raster_id'])
+            continue
+        try:
+            with bar.stage('mosaic'):
+                mosaic_tiles(job,tiles[job['raster_id']],mosaic)
+        except Exception as e:
+            print('\nERROR: Cannot merge tiles of raster {0}. {1}'.format(job['raster_id'],e))
+            failed_rasters.append(job['raster_id'])
+    return failed_rasters
+
+
+def mosaic_tiles(job, tiles, mosaic='vrt'):
+    '''
+    Write the tiles of job as <raster_id>.vrt or merge them into <raster_id>.tif
+    and record it in the manifest. Raises ValueError if the tiles are not on
+    one pixel grid.
+    '''
+    fhs=[_outfilename(tile) for tile in tiles]
+    _check_tile_grid(fhs)
+    if mosaic=='vrt':
+        outfilename=os.path.join(job['Dir'],'{0}.vrt'.format(job['raster_id']))
+        gdal.BuildVRT(outfilename,fhs)
+        if job.get('compact'):
+            gis.CopyScale(fhs[0],outfilename)
+        open_manifest(job['Dir']).set_complete(job,outfilename)
+        return outfilename
+    vrt='/vsimem/mosaic_{0}.vrt'.format(job['raster_id'])
+    outfilename=_outfilename(job)
+    if os.path.exists(outfilename):
+        os.remove(outfilename)
+    try:
+        gdal.BuildVRT(vrt,fhs)
+        gdal.Translate(outfilename,vrt,format='GTiff')
+    finally:
+        gdal.Unlink(vrt)
+    if job.get('compact'):
+        gis.CopyScale(fhs[0],outfilename)
+    open_manifest(job['Dir']).set_complete(job,outfilename)
+    for fh in fhs:
+        os.remove(fh)
+    open_manifest(tiles[0]['Dir']).remove([tile['raster_id'] for tile in tiles])
+    return outfilename
+
+
+def _check_tile_grid(fhs):
+    '''
+    Raise ValueError if the tiles have other pixel sizes or origins that are
+    not a whole number of pixels apart
+    '''
+    grids=[gis.GridSpec.from_file(fh) for fh in fhs]
+    x0,xres,_,y0,_,yres=grids[0].GeoT
+    for fh,grid in zip(fhs,grids):
+        x,dx,_,y,_,dy=grid.GeoT
+        offsets=((x-x0)/xres,(y-y0)/yres)
+        if (abs(dx-xres)>1e-9*abs(xres) or abs(dy-yres)>1e-9*abs(yres) or
+            any(abs(offset-round(offset))>1e-3 for offset in offsets)):
+            raise ValueError('Tile {0} is not on the pixel grid of {1}'.format(fh,fhs[0]))
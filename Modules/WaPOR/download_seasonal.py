@@ -5,15 +5,14 @@ Created on Tue Jul 23 11:25:33 2019
 @author: ntr002
 """
 import WaPOR
-from datetime import datetime
-import requests
 import os
-from WaPOR import GIS_functions as gis
+from WaPOR import download_pool
 
 
 def main(Dir, data='AETI',Startdate='2009-01-01', Enddate='2018-12-31', 
          latlim=[-40.05, 40.05], lonlim=[-30.5, 65.05],level=1, 
-         version = 2, Waitbar = 1,cached_catalog=True):
+         version = 2, Waitbar = 1,cached_catalog=True,max_workers=None,cache=None,
+         tile_size=None,mosaic='vrt',compact=False):
     """
     This function downloads seasonal WAPOR LCC data
 
@@ -24,9 +23,38 @@ def main(Dir, data='AETI',Startdate='2009-01-01', Enddate='2018-12-31',
     latlim -- [ymin, ymax] (values must be between -40.05 and 40.05)
     lonlim -- [xmin, xmax] (values must be between -30.05 and 65.05)
     cached_catalog -- True  Use a cached catalog. False Load a new catalog from the database
+    max_workers -- number of rasters (tiles with tile_size) downloaded at once, default None downloads whole rasters one by one and sizes the pool of tiles from the CPU count
+    cache -- RasterCache (or its directory) to share rasters between projects, None to not use a cache
+    tile_size -- None to download each raster at once, or size in degrees of tiles that are downloaded separately
+    mosaic -- 'vrt' to write the tiles of each raster as a VRT, 'tif' to merge them into one GeoTIFF
+    compact -- True to keep the integer values of WaPOR and store the multiplier as scale metadata, read back by OpenAsArray
     """
     print(f'\nDownload WaPOR Level {level} seasonal {data} data for the period {Startdate} till {Enddate}')
 
+    resolved=download_jobs(Dir,data=data,Startdate=Startdate,Enddate=Enddate,
+                           latlim=latlim,lonlim=lonlim,level=level,version=version,
+                           cached_catalog=cached_catalog,compact=compact)
+    if resolved is None:
+        return None
+    Dir,jobs=resolved
+    if tile_size is None:
+        download_pool.run(jobs,max_workers=1 if max_workers is None else max_workers,
+                          Waitbar=Waitbar,cache=cache)
+    else:
+        download_pool.run_tiled(jobs,tile_size,mosaic=mosaic,
+                                max_workers=max_workers,Waitbar=Waitbar,cache=cache)
+    return Dir
+
+
+def download_jobs(Dir, data='AETI', Startdate='2009-01-01', Enddate='2018-12-31',
+                  latlim=[-40.05, 40.05], lonlim=[-30.5, 65.05], level=1,
+                  version = 2, cached_catalog=True, compact=False):
+    """
+    This function finds the cube and the available seasonal rasters of main
+
+    Returns the output directory and the list of download_pool jobs, or None
+    if the cube or the available data cannot be found
+    """
     # Download data
     WaPOR.API.version=version
     bbox=[lonlim[0],latlim[0],lonlim[1],latlim[1]]
@@ -57,49 +85,21 @@ def main(Dir, data='AETI',Startdate='2009-01-01', Enddate='2018-12-31',
     except:
         print('ERROR: cannot get list of available data')
         return None
-    if Waitbar == 1:
-        import WaPOR.WaitbarConsole as WaitbarConsole
-        total_amount = len(df_avail)
-        amount = 0
-        WaitbarConsole.printWaitBar(amount, total_amount, prefix = 'Progress:', suffix = 'Complete', length = 50)
-    
     Dir=os.path.join(Dir,'WAPOR.v%s_seasonal_%s' %(version,cube_code))
     if not os.path.exists(Dir):
         os.makedirs(Dir)
-        
-    for index,row in df_avail.iterrows():   
+
+    jobs=[]
+    for index,row in df_avail.iterrows():
         season_val={'Season 1':'S1','Season 2':'S2'}
         if data=='PHE':
             stage_val={'End':'EOS','Maximum':'MOS','Start':'SOS'}
             raster_stage=stage_val[row['STAGE']]
         else:
             raster_stage=None
-        
-        download_url=WaPOR.API.getCropRasterURL(bbox,cube_code,
-                                               row['time_code'],
-                                               row['raster_id'],
-                                               WaPOR.API.APIToken,
-                                               season=season_val[row['SEASON']],
-                                               stage=raster_stage)               
-        filename='{0}.tif'.format(row['raster_id'])
-        outfilename=os.path.join(Dir,filename)       
-        download_file=os.path.join(Dir,'raw_{0}.tif'.format(row['raster_id']))
-        #print(download_url)
-        #Download raster file
-        resp=requests.get(download_url) 
-        open(download_file,'wb').write(resp.content) 
-        driver, NDV, xsize, ysize, GeoT, Projection= gis.GetGeoInfo(download_file)
-        Array = gis.OpenAsArray(download_file,nan_values=True)
-        CorrectedArray=Array*multiplier
-        gis.CreateGeoTiff(outfilename,CorrectedArray,
-                          driver, NDV, xsize, ysize, GeoT, Projection)
-        os.remove(download_file)        
-
-        if Waitbar == 1:                 
-            amount += 1
-            WaitbarConsole.printWaitBar(amount, total_amount, 
-                                        prefix = 'Progress:', 
-                                        suffix = 'Complete', 
-                                        length = 50)
-    return Dir
+        jobs.append(download_pool.new_job(row,bbox,cube_code,Dir,multiplier,
+                                          season=season_val[row['SEASON']],
+                                          stage=raster_stage,
+                                          compact=compact))
+    return Dir,jobs
     
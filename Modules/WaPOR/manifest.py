@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Download manifest of an output directory of the download_* modules.
+
+manifest.json records for every raster_id its time_code, bbox and whether it
+is stored compact, and either the file name, cube code, number of days the
+values were multiplied with, byte size and sha256 checksum of the finished
+raster or the download url and expected size of a transfer that was
+interrupted. Reruns use it to skip finished rasters and to resume interrupted
+transfers.
+"""
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME='manifest.json'
+
+_manifests={}
+_manifests_lock=threading.Lock()
+
+
+def open_manifest(Dir):
+    '''
+    Manifest of output directory Dir, shared by all threads of the process
+    '''
+    Dir=os.path.abspath(Dir)
+    with _manifests_lock:
+        if Dir not in _manifests:
+            _manifests[Dir]=Manifest(Dir)
+        return _manifests[Dir]
+
+
+def checksum(fh, chunk_size=1024*1024):
+    '''
+    sha256 hex digest of file fh
+    '''
+    sha=hashlib.sha256()
+    with open(fh,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, Dir):
+        self.Dir=Dir
+        self.fh=os.path.join(Dir,MANIFEST_NAME)
+        self._lock=threading.Lock()
+        self.entries={}
+        if os.path.exists(self.fh):
+            try:
+                with open(self.fh) as f:
+                    self.entries=json.load(f)
+            except ValueError:
+                print('ERROR: Cannot read {0}, all rasters will be downloaded again'.format(self.fh))
+
+    def _save(self):
+        #write to a temporary file first so a crash never leaves half a manifest
+        tmp=self.fh+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump(self.entries,f,indent=1,sort_keys=True)
+        os.replace(tmp,self.fh)
+
+    def _matches(self, entry, job):
+        return (entry.get('time_code')==job['time_code'] and
+                list(entry.get('bbox',[]))==list(job['bbox']) and
+                entry.get('compact',False)==job.get('compact',False))
+
+    def is_complete(self, job, outfilename, verify=False):
+        '''
+        True if outfilename was finished for the same time_code and bbox and
+        still has the recorded size (and checksum if verify is True)
+        '''
+        with self._lock:
+            entry=self.entries.get(job['raster_id'])
+        if entry is None or entry.get('status')!='complete':
+            return False
+        if not self._matches(entry,job) or not os.path.exists(outfilename):
+            return False
+        if os.path.getsize(outfilename)!=entry['size']:
+            return False
+        return not verify or checksum(outfilename)==entry['sha256']
+
+    def partial(self, job):
+        '''
+        Entry of an interrupted transfer of job, or None
+        '''
+        with self._lock:
+            entry=self.entries.get(job['raster_id'])
+        if entry is None or entry.get('status')!='partial' or not self._matches(entry,job):
+            return None
+        return entry
+
+    def set_partial(self, job, download_url, size):
+        with self._lock:
+            self.entries[job['raster_id']]={'status':'partial',
+                                            'time_code':job['time_code'],
+                                            'bbox':list(job['bbox']),
+                                            'url':download_url,
+                                            'size':size,
+                                            'compact':job.get('compact',False)}
+            self._save()
+
+    def set_complete(self, job, outfilename):
+        entry={'status':'complete',
+               'time_code':job['time_code'],
+               'bbox':list(job['bbox']),
+               'file':os.path.basename(outfilename),
+               'cube_code':job.get('cube_code'),
+               'ndays':job.get('ndays'),
+               'size':os.path.getsize(outfilename),
+               'sha256':checksum(outfilename),
+               'compact':job.get('compact',False)}
+        with self._lock:
+            self.entries[job['raster_id']]=entry
+            self._save()
+
+    def remove(self, raster_ids):
+        '''
+        Forget the entries of raster_ids, ex. of tiles merged into one raster
+        '''
+        with self._lock:
+            for raster_id in raster_ids:
+                self.entries.pop(raster_id,None)
+            self._save()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Progress and throughput of the download and processing loops.
+
+A Progress counts finished items, transferred bytes and errors, and sums the
+seconds spent per stage of an item, e.g. job wait, transfer, scaling and
+write. On every update it passes a snapshot with rates and the estimated
+time left to its reporters:
+- ConsoleReporter draws the WaitbarConsole bar with rate and ETA
+- JsonLinesReporter appends one JSON object per update to a log file
+- CallbackReporter calls a function with the event and the snapshot
+
+The Waitbar argument of download_pool.run and GIS_functions.MatchProjResNDV
+is turned into a Progress with progress(): 1 for the console bar, the file
+name of a JSON lines log, a function for a callback, a list of these, or a
+Progress shared by several runs, e.g. by a download and its resampling.
+"""
+import contextlib
+import datetime
+import json
+import threading
+import time
+
+
+class Progress(object):
+    def __init__(self, total=0, reporters=(), name='Progress'):
+        '''
+        total: int
+            number of items
+        reporters: list
+            objects with a report(event, snapshot) method
+        name: str
+            name of the loop in the snapshots
+        '''
+        self.total=total
+        self.reporters=list(reporters)
+        self.name=name
+        self.done=0
+        self.errors=0
+        self.retries=0
+        self.bytes=0
+        self._retried=0
+        self.stages={}
+        self.start=time.perf_counter()
+        self._lock=threading.Lock()
+        self._report('start')
+
+    def extend(self, total):
+        '''
+        Add total items, e.g. of another run sharing this Progress. Items
+        taken back with retry are already in total and are not added again.
+        '''
+        with self._lock:
+            reused=min(self._retried,total)
+            self._retried-=reused
+            self.total+=total-reused
+            self._report('start')
+
+    def retry(self, count):
+        '''
+        Take back count failed items that are processed again, they are no
+        longer counted as done and as errors
+        '''
+        with self._lock:
+            self.done-=count
+            self.errors-=count
+            self.retries+=count
+            self._retried+=count
+
+    def add_bytes(self, nbytes):
+        with self._lock:
+            self.bytes+=nbytes
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            stats=self.stages.setdefault(stage,{'count':0,'seconds':0.0,'max':0.0})
+            stats['count']+=1
+            stats['seconds']+=seconds
+            stats['max']=max(stats['max'],seconds)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        '''
+        Add the seconds spent in the with block to stage
+        '''
+        start=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage,time.perf_counter()-start)
+
+    def item(self, item=None, error=None):
+        '''
+        Count a finished item, error is the exception of a failed item
+        '''
+        with self._lock:
+            self.done+=1
+            if error is not None:
+                self.errors+=1
+            self._report('item',item=item,error=None if error is None else str(error))
+
+    def close(self):
+        with self._lock:
+            self._report('end')
+
+    def snapshot(self):
+        '''
+        Counts, rates, estimated seconds left (eta) and per stage the number
+        of calls, total, mean and maximum seconds
+        '''
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        elapsed=time.perf_counter()-self.start
+        rate=self.done/elapsed if elapsed>0 else 0.0
+        eta=None
+        if rate>0:
+            eta=max(self.total-self.done,0)/rate
+        stages={}
+        for stage,stats in self.stages.items():
+            stages[stage]=dict(stats,mean=stats['seconds']/stats['count'])
+        return {'name':self.name,'total':self.total,'done':self.done,
+                'errors':self.errors,'retries':self.retries,
+                'bytes':self.bytes,'elapsed':elapsed,
+                'items_per_s':rate,
+                'bytes_per_s':self.bytes/elapsed if elapsed>0 else 0.0,
+                'eta':eta,'stages':stages}
+
+    def _report(self, event, **kwargs):
+        if not self.reporters:
+            return
+        snapshot=self._snapshot()
+        snapshot.update(kwargs)
+        for reporter in self.reporters:
+            reporter.report(event,snapshot)
+
+
+class ConsoleReporter(object):
+    def __init__(self, prefix='Progress:', length=50):
+        self.prefix=prefix
+        self.length=length
+
+    def report(self, event, snapshot):
+        import WaPOR.WaitbarConsole as WaitbarConsole
+        if event=='end':
+            return
+        suffix='Complete'
+        if snapshot['eta'] is not None and snapshot['done']<snapshot['total']:
+            suffix+=' {0:.2f}/s ETA {1}'.format(snapshot['items_per_s'],
+                                                 datetime.timedelta(seconds=round(snapshot['eta'])))
+        if snapshot['errors']:
+            suffix+=' {0} errors'.format(snapshot['errors'])
+        WaitbarConsole.printWaitBar(snapshot['done'],snapshot['total'],
+                                    prefix=self.prefix,suffix=suffix,
+                                    length=self.length)
+
+
+class JsonLinesReporter(object):
+    def __init__(self, log_file, interval=0.0):
+        '''
+        log_file: str
+            file the snapshots are appended to, one JSON object per line
+        interval: float
+            minimum seconds between two logged item updates
+        '''
+        self.log_file=log_file
+        self.interval=interval
+        self._last=None
+
+    def report(self, event, snapshot):
+        now=time.perf_counter()
+        if (event=='item' and snapshot.get('error') is None and
+            self._last is not None and now-self._last<self.interval):
+            return
+        self._last=now
+        record=dict(snapshot,event=event,
+                    time=datetime.datetime.now().isoformat(timespec='milliseconds'))
+        with open(self.log_file,'a') as f:
+            f.write(json.dumps(record)+'\n')
+
+
+class CallbackReporter(object):
+    def __init__(self, callback):
+        '''
+        callback: callable
+            called as callback(event, snapshot), event is 'start', 'item' or 'end'
+        '''
+        self.callback=callback
+
+    def report(self, event, snapshot):
+        self.callback(event,snapshot)
+
+
+def progress(Waitbar, total, name='Progress'):
+    '''
+    Progress of total items for the Waitbar argument of a loop
+
+    Waitbar: int, str, callable, list or Progress
+        1 for the console bar, 0 or None for no output, the file name of a
+        JSON lines log, a function for a callback, a list of these, or a
+        Progress to which total items are added
+    '''
+    if isinstance(Waitbar,Progress):
+        Waitbar.extend(total)
+        return Waitbar
+    if not isinstance(Waitbar,(list,tuple)):
+        Waitbar=[Waitbar]
+    reporters=[]
+    for value in Waitbar:
+        if value is None or value is False or value==0:
+            continue
+        if value is True or value==1:
+            reporters.append(ConsoleReporter())
+        elif isinstance(value,str):
+            reporters.append(JsonLinesReporter(value))
+        elif callable(value):
+            reporters.append(CallbackReporter(value))
+        else:
+            reporters.append(value)
+    return Progress(total,reporters,name=name)
@@ -0,0 +1,718 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in of the WaPOR gismgr API for offline and throughput testing.
+
+StandInServer answers the sign-in, token, catalog, query (MDAQuery_Table,
+CropRaster, PixelTimeSeries, AreaStatsTimeSeries), job and download requests
+of __WaPOR_API_class on a local port. Cube records come from a cached catalog
+pickle, dimension members are generated per cube and CropRaster jobs produce
+int16 GeoTIFFs of the requested bbox with deterministic pixel values.
+latency, job_delay, failure_rate and job_failure_rate make the answers slow
+or unreliable in a repeatable way (seed).
+
+With upstream and record set, requests are forwarded to the real server and
+its answers written to a recording directory. With replay set, recorded
+answers are served again in the order they were recorded, and requests that
+were not recorded get the synthetic answer. Access and refresh tokens are not
+written to recordings.
+
+Example:
+from WaPOR import standin
+with standin.StandInServer(latency=0.05,job_delay=1) as server:
+    with server.install(): #WaPOR.API now sends its requests to server.base_url
+        WaPOR.download_dekadal(Dir='C:/Temp/', Startdate='2009-02-24',
+                               Enddate='2009-03-09',latlim=[7,8],lonlim=[38,39])
+    print(server.stats())
+"""
+import contextlib
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import numpy as np
+
+from .WaporAPI import __WaPOR_API_class
+
+ROOT='/gismgr/api/v1/'
+MARK='http://wapor-standin'+ROOT #base url of the server in recorded answers
+NODATA=-9999
+PIXEL_SIZE={'L1':1/448.,'L2':1/1120.,'L3':1/3360.} #degrees
+FULL_BBOX=[-30.,-40.,65.,40.] #extent of rasters of the download endpoint
+WHAT_MEMBERS={'COUNTRY':[('ETH','Ethiopia'),('KEN','Kenya'),('MLI','Mali')],
+              'BASIN':[('AWA','Awash'),('NIL','Nile'),('NIG','Niger')],
+              'SEASON':[('S1','Season 1'),('S2','Season 2')],
+              'STAGE':[('SOS','Start'),('MOS','Maximum'),('EOS','End')]}
+TOKEN_PATHS=('iam/sign-in/','iam/token')
+
+
+class StandInServer(object):
+    def __init__(self, port=0, latency=0.0, job_delay=0.0, failure_rate=0.0,
+                 job_failure_rate=0.0, bandwidth=None, max_size=4096,
+                 years=(2009,2023), seed=0, catalog=None, expires_in=3600,
+                 upstream=None, record=None, replay=None):
+        '''
+        port: int
+            local port, default a free port
+        latency: float
+            seconds waited before every answer
+        job_delay: float
+            seconds a job stays RUNNING after it was submitted
+        failure_rate: float
+            fraction of requests answered with 503
+        job_failure_rate: float
+            fraction of jobs that end COMPLETED WITH ERRORS
+        bandwidth: float
+            bytes per second of raster transfers, default unlimited
+        max_size: int
+            maximum width and height in pixels of a synthetic raster, larger
+            extents get coarser pixels
+        years: tuple
+            first and last year of the generated time members
+        seed: int
+            seed of the failures and pixel values
+        catalog: str
+            catalog pickle of which the cube records are served, default
+            catalog_2.pkl of this package
+        expires_in: int
+            seconds an access token is valid
+        upstream: str
+            base url of the real server, with record the answers of upstream
+            are recorded
+        record: str
+            directory the answers of upstream are recorded to
+        replay: str
+            directory of a recording of which the answers are served
+        '''
+        if catalog is None:
+            catalog=os.path.join(os.path.dirname(__file__),'catalog_2.pkl')
+        self.catalog=catalog
+        with open(catalog,'rb') as handle:
+            df=pickle.load(handle)
+        self.cubes={record['code']:record for record in df.to_dict('records')}
+        self.latency=latency
+        self.job_delay=job_delay
+        self.failure_rate=failure_rate
+        self.job_failure_rate=job_failure_rate
+        self.bandwidth=bandwidth
+        self.max_size=max_size
+        self.years=years
+        self.seed=seed
+        self.expires_in=expires_in
+        self.upstream=upstream
+        self.recording=None
+        if upstream is not None and record is not None:
+            self.recording=Recording(record)
+        elif replay is not None:
+            self.recording=Recording(replay)
+        self.jobs={}
+        self.files={}
+        self.requests={}
+        self.bytes_sent=0
+        self._random=random.Random(seed)
+        self._ids=itertools.count(1)
+        self._lock=threading.Lock()
+        self._session=None
+        self.httpd=ThreadingHTTPServer(('127.0.0.1',port),_Handler)
+        self.httpd.daemon_threads=True
+        self.httpd.standin=self
+        self.base_url='http://127.0.0.1:{0}{1}'.format(self.httpd.server_address[1],ROOT)
+        self._thread=None
+
+    def start(self):
+        '''
+        Serve requests in a background thread
+        '''
+        self._thread=threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @contextlib.contextmanager
+    def install(self, APIToken='standin', **kwargs):
+        '''
+        Context in which WaPOR.API is a client of this server, yields the
+        client. kwargs are passed to the API class. WaPOR.API and
+        WaPOR.APIToken are restored on exit.
+        '''
+        import WaPOR
+        previous={name:WaPOR.__dict__[name] for name in ('API','APIToken')
+                  if name in WaPOR.__dict__}
+        WaPOR.APIToken=APIToken
+        WaPOR.API=api(self.base_url,APIToken,catalog=self.catalog,**kwargs)
+        try:
+            yield WaPOR.API
+        finally:
+            for name in ('API','APIToken'):
+                if name in previous:
+                    setattr(WaPOR,name,previous[name])
+                else:
+                    delattr(WaPOR,name)
+
+    def stats(self):
+        '''
+        Number of requests per endpoint and bytes of raster data sent
+        '''
+        with self._lock:
+            return {'requests':dict(self.requests),'bytes':self.bytes_sent}
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint]=self.requests.get(endpoint,0)+1
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random()<rate
+
+    def _handle(self, handler, method):
+        '''
+        Answer one request of handler
+        '''
+        length=int(handler.headers.get('Content-Length',0))
+        body=handler.rfile.read(length) if length else b''
+        url=urlsplit(handler.path)
+        if not url.path.startswith(ROOT):
+            return self._send(handler,*_error(404,'Unknown path {0}'.format(url.path)))
+        path=url.path[len(ROOT):]
+        if self.latency:
+            time.sleep(self.latency)
+        if self._chance(self.failure_rate):
+            self._count('failure')
+            return self._send(handler,*_error(503,'Service unavailable'))
+        try:
+            answer=None
+            if self.recording is not None:
+                key=self.recording.key(method,path,url.query,body)
+                if self.upstream is not None:
+                    answer=self._forward(key,method,path,url.query,handler.headers,body)
+                else:
+                    answer=self.recording.get(key)
+                    if answer is not None:
+                        self._count('replay')
+            if answer is None:
+                answer=self._route(method,path,dict(parse_qsl(url.query)),handler.headers,body)
+        except Exception as e:
+            answer=_error(500,'{0}: {1}'.format(type(e).__name__,e))
+        status,content_type,data=answer
+        if 'json' in content_type:
+            data=data.replace(MARK.encode(),self.base_url.encode())
+        self._send(handler,status,content_type,data,handler.headers.get('Range'))
+
+    def _send(self, handler, status, content_type, data, byte_range=None):
+        total=len(data)
+        start,end=0,total
+        if byte_range and status==200 and byte_range.startswith('bytes='):
+            first,_,last=byte_range[6:].partition('-')
+            start=int(first or 0)
+            end=int(last)+1 if last else total
+            status=206
+        handler.send_response(status)
+        handler.send_header('Content-Type',content_type)
+        handler.send_header('Content-Length',str(end-start))
+        if status==206:
+            handler.send_header('Content-Range','bytes {0}-{1}/{2}'.format(start,end-1,total))
+        handler.end_headers()
+        if 'json' in content_type:
+            handler.wfile.write(data)
+            return
+        chunk_size=64*1024
+        for offset in range(start,end,chunk_size):
+            chunk=data[offset:min(offset+chunk_size,end)]
+            handler.wfile.write(chunk)
+            with self._lock:
+                self.bytes_sent+=len(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk)/self.bandwidth)
+
+    def _route(self, method, path, params, headers, body):
+        '''
+        Synthetic answer of a request as (status, content type, data)
+        '''
+        parts=path.strip('/').split('/')
+        if path in TOKEN_PATHS:
+            self._count(parts[-1])
+            if path=='iam/sign-in/' and not headers.get('X-GISMGR-API-KEY'):
+                return _error(401,'Missing API key')
+            return self._token()
+        if parts[0]=='files':
+            self._count('raster')
+            name=parts[-1][:-len('.tif')]
+            if name not in self.files:
+                return _error(404,'Unknown file {0}'.format(parts[-1]))
+            return 200,'image/tiff',self._raster(*self.files[name])
+        if parts[0]=='download':
+            self._count('download')
+            return self._download(params)
+        if parts[0]=='query':
+            query=json.loads(body.decode('utf-8'))
+            self._count('query/{0}'.format(query.get('type')))
+            return self._query(query,headers)
+        if parts[:2]==['catalog','workspaces'] and len(parts)>=4:
+            if parts[3]=='jobs' and len(parts)==5:
+                self._count('jobs')
+                return self._job(parts[4])
+            if parts[3]=='cubes':
+                self._count(parts[-1] if len(parts)>5 else 'cubes')
+                return self._catalog(parts[4:],params)
+        return _error(404,'Unknown path {0}'.format(path))
+
+    def _token(self):
+        n=next(self._ids)
+        return _json({'response':{'accessToken':'standin-access-{0}'.format(n),
+                                  'refreshToken':'standin-refresh-{0}'.format(n),
+                                  'expiresIn':self.expires_in}})
+
+    def _catalog(self, parts, params):
+        if not parts:
+            tag=params.get('tags')
+            cubes=[{k:v for k,v in record.items() if k not in ('measure','dimension')}
+                   for record in self.cubes.values()
+                   if tag is None or any(t['name']==tag for t in _list(record['tags']))]
+            return _json({'response':cubes})
+        record=self.cubes.get(parts[0])
+        if record is None:
+            return _error(404,'Unknown cube {0}'.format(parts[0]))
+        if parts[1:]==['measures']:
+            return _json({'response':[record['measure']]})
+        if parts[1:]==['dimensions']:
+            return _json({'response':record['dimension']})
+        if len(parts)==4 and parts[1]=='dimensions' and parts[3]=='members':
+            members=[{'code':code,'caption':caption,'description':caption}
+                     for code,caption,_ in self._members(record,parts[2])]
+            return _json({'response':members})
+        return _error(404,'Unknown path {0}'.format('/'.join(parts)))
+
+    def _members(self, record, dims_code):
+        '''
+        (code, caption, raster id part) of the members of a dimension
+        '''
+        for dims in record['dimension']:
+            if dims['code']==dims_code and dims['type']=='TIME':
+                return _timeMembers(dims_code,self.years)
+        return [(code,caption,code.lower())
+                for code,caption in WHAT_MEMBERS.get(dims_code,[('ALL','All')])]
+
+    def _query(self, query, headers):
+        params=query.get('params',{})
+        record=self.cubes.get(params.get('cube',{}).get('code'))
+        if record is None:
+            return _error(400,'Unknown cube')
+        if query['type'] in ('CropRaster','AreaStatsTimeSeries'):
+            if not headers.get('Authorization','').startswith('Bearer '):
+                return _error(401,'Missing access token')
+        if query['type']=='MDAQuery_Table':
+            return self._table(record,params)
+        if query['type']=='CropRaster':
+            return self._cropRaster(record,params)
+        if query['type']=='PixelTimeSeries':
+            point=params['point']
+            header,items=self._series(record,params,(point['x'],point['y']),1)
+            return _json({'response':{'header':[header,record['measure']['code']],
+                                      'items':items}})
+        if query['type']=='AreaStatsTimeSeries':
+            shape=json.dumps(params['shape'],sort_keys=True)
+            header,items=self._series(record,params,shape,3)
+            output={'header':[header,'minimum','maximum','average'],
+                    'items':[[time_caption,min(values),max(values),sum(values)/len(values)]
+                             for time_caption,*values in items]}
+            return self._newJob('AREA STATS',output)
+        return _error(400,'Unknown query type {0}'.format(query['type']))
+
+    def _selected(self, record, dimension):
+        '''
+        Members of a query dimension, filtered by its range or values
+        '''
+        members=self._members(record,dimension['code'])
+        if 'range' in dimension:
+            start,end=dimension['range'].strip('[)').split(',')
+            return [m for m in members if m[0][1:11]<end and m[0][12:22]>start]
+        values=dimension.get('values',[])
+        return [m for m in members if m[0] in values]
+
+    def _table(self, record, params):
+        dims={dimension['code']:self._selected(record,dimension)
+              for dimension in params['dimensions']}
+        rows=params['projection']['rows']
+        prefix=record['code'].rsplit('_',1)[0]
+        items=[]
+        for combination in itertools.product(*[dims[code] for code in rows]):
+            raster_id='_'.join([prefix]+[member[2] for member in combination])
+            cells=[{'type':'ROW_HEADER','value':member[1]} for member in combination]
+            cells.append({'type':'DATA_CELL','value':None,
+                          'metadata':{'raster':{'id':raster_id,
+                                                'bbox':[{'srid':'EPSG:4326',
+                                                         'value':FULL_BBOX}]}}})
+            items.append(cells)
+        return _json({'response':{'items':items}})
+
+    def _cropRaster(self, record, params):
+        polygon=params['shape']['coordinates'][0]
+        xs=[point[0] for point in polygon]
+        ys=[point[1] for point in polygon]
+        bbox=[min(xs),min(ys),max(xs),max(ys)]
+        values=[str(value) for dimension in params['dimensions']
+                for value in dimension.get('values',[])]
+        name='crop_{0}'.format(next(self._ids))
+        self.files[name]=(record['code'],','.join(values),bbox)
+        return self._newJob('CROP RASTER',{'downloadUrl':'{0}files/{1}.tif'.format(self.base_url,name)})
+
+    def _download(self, params):
+        record=self.cubes.get(params.get('cubeCode'))
+        if record is None or 'rasterId' not in params:
+            return _error(400,'Unknown cube or raster')
+        name='full_{0}'.format(params['rasterId'])
+        self.files[name]=(record['code'],params['rasterId'],FULL_BBOX)
+        return _json({'response':{'downloadUrl':'{0}files/{1}.tif'.format(self.base_url,name),
+                                  'expiresIn':3600}})
+
+    def _newJob(self, job_type, output):
+        job_id='job-{0}'.format(next(self._ids))
+        self.jobs[job_id]={'type':job_type,'ready':time.time()+self.job_delay,
+                           'failed':self._chance(self.job_failure_rate),
+                           'output':output}
+        href='{0}catalog/workspaces/WAPOR/jobs/{1}'.format(self.base_url,job_id)
+        return _json({'response':{'code':job_id,'type':job_type,'status':'WAITING',
+                                  'links':[{'rel':'self','href':href}]}})
+
+    def _job(self, job_id):
+        job=self.jobs.get(job_id)
+        if job is None:
+            return _error(404,'Unknown job {0}'.format(job_id))
+        response={'code':job_id,'type':job['type'],'status':'RUNNING'}
+        if time.time()>=job['ready']:
+            if job['failed']:
+                response.update(status='COMPLETED WITH ERRORS',log=['stand-in job failure'])
+            else:
+                response.update(status='COMPLETED',output=job['output'])
+        return _json({'response':response})
+
+    def _series(self, record, params, location, nvalues):
+        '''
+        Time dimension code and rows [caption, values...] of a time series
+        query, values depend only on cube, location and time
+        '''
+        for dimension in params['dimensions']:
+            if 'range' in dimension:
+                members=self._selected(record,dimension)
+                items=[]
+                for code,caption,_ in members:
+                    rng=random.Random(_seed(self.seed,record['code'],location,code))
+                    items.append([caption]+[round(rng.uniform(0,100),2) for _ in range(nvalues)])
+                return dimension['code'],items
+        return 'time',[]
+
+    def _raster(self, cube_code, raster_key, bbox):
+        '''
+        GeoTIFF bytes of a synthetic raster of cube_code over bbox, like the
+        WaPOR API widened to whole pixels of the grid of the cube
+        '''
+        pixel_size=PIXEL_SIZE.get(cube_code[:2],PIXEL_SIZE['L1'])
+        #1e-6 pixel tolerance for the rounding of bbox edges on the grid
+        xmin,ymin=[np.floor(v/pixel_size+1e-6)*pixel_size for v in bbox[:2]]
+        xmax,ymax=[np.ceil(v/pixel_size-1e-6)*pixel_size for v in bbox[2:]]
+        width=max(1,int(round((xmax-xmin)/pixel_size)))
+        height=max(1,int(round((ymax-ymin)/pixel_size)))
+        scale=max(width/self.max_size,height/self.max_size,1)
+        if scale>1:
+            width=max(1,int(width/scale))
+            height=max(1,int(height/scale))
+        rng=np.random.default_rng(_seed(self.seed,cube_code,raster_key,bbox))
+        array=rng.integers(-50,1000,size=(height,width),dtype=np.int16)
+        array[0,0]=NODATA
+        return geotiff(array,((xmax-xmin)/width,(ymax-ymin)/height),(xmin,ymax))
+
+    def _forward(self, key, method, path, query, headers, body):
+        '''
+        Answer of upstream to a request, recorded under key
+        '''
+        import requests
+        if self._session is None:
+            self._session=requests.Session()
+        parts=path.strip('/').split('/')
+        self._count('upstream')
+        if parts[0]=='files':
+            url=self.recording.remote.get(parts[-1])
+            if url is None:
+                return _error(404,'Unknown file {0}'.format(parts[-1]))
+            send_headers={}
+        else:
+            url=self.upstream+path+('?'+query if query else '')
+            send_headers={name:headers[name] for name in
+                          ('X-GISMGR-API-KEY','Authorization','Content-Type')
+                          if name in headers}
+        resp=self._session.request(method,url,headers=send_headers,
+                                   data=body or None,timeout=(10,300))
+        content_type=resp.headers.get('Content-Type','application/octet-stream')
+        data=resp.content
+        stored=data
+        if 'json' in content_type:
+            data,stored=self.recording.rewrite(data,self.upstream)
+        self.recording.add(key,resp.status_code,content_type,stored)
+        return resp.status_code,content_type,data
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1' #keep-alive, like the real server
+    disable_nagle_algorithm=True
+
+    def do_GET(self):
+        self.server.standin._handle(self,'GET')
+
+    def do_POST(self):
+        self.server.standin._handle(self,'POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Recording(object):
+    '''
+    Answers of the real server recorded in directory Dir
+
+    index.json lists per request key the answers in the order they were
+    received, the bodies are stored in files named by their sha256.
+    '''
+    def __init__(self, Dir):
+        self.Dir=Dir
+        self.index_file=os.path.join(Dir,'index.json')
+        self.index={}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index=json.load(f)
+        self.remote={} #file name of a raster link and its upstream url
+        self._served={}
+        self._lock=threading.Lock()
+
+    def key(self, method, path, query, body):
+        '''
+        Request key independent of tokens, query order and json formatting
+        '''
+        if path in TOKEN_PATHS:
+            return '{0} {1}'.format(method,path)
+        query=urlencode(sorted(parse_qsl(query)))
+        if body:
+            try:
+                body=json.dumps(json.loads(body.decode('utf-8')),sort_keys=True).encode('utf-8')
+            except ValueError:
+                pass
+            query+='#'+hashlib.sha256(body).hexdigest()
+        return '{0} {1}?{2}'.format(method,path,query)
+
+    def get(self, key):
+        '''
+        Next recorded answer of key as (status, content type, data), the last
+        answer is repeated, or None if key was not recorded
+        '''
+        with self._lock:
+            answers=self.index.get(key)
+            if not answers:
+                return None
+            n=self._served.get(key,0)
+            self._served[key]=n+1
+            answer=answers[min(n,len(answers)-1)]
+        with open(os.path.join(self.Dir,answer['body']),'rb') as f:
+            return answer['status'],answer['content_type'],f.read()
+
+    def add(self, key, status, content_type, data):
+        name=hashlib.sha256(data).hexdigest()
+        fh=os.path.join(self.Dir,name)
+        with self._lock:
+            if not os.path.exists(fh):
+                os.makedirs(self.Dir,exist_ok=True)
+                with open(fh,'wb') as f:
+                    f.write(data)
+            self.index.setdefault(key,[]).append({'status':status,
+                                                  'content_type':content_type,
+                                                  'body':name})
+            tmp_file=self.index_file+'.tmp'
+            with open(tmp_file,'w') as f:
+                json.dump(self.index,f,indent=1)
+            os.replace(tmp_file,self.index_file)
+
+    def rewrite(self, data, upstream):
+        '''
+        Point the links of a json answer of upstream to the stand-in.
+        Returns the answer to serve and the answer to record, which has no
+        access or refresh token.
+        '''
+        try:
+            resp_vp=json.loads(data.decode('utf-8'))
+        except ValueError:
+            return data,data
+        response=resp_vp.get('response') if isinstance(resp_vp,dict) else None
+        if isinstance(response,dict):
+            for links in (response,response.get('output')):
+                if isinstance(links,dict) and 'downloadUrl' in links:
+                    url=links['downloadUrl']
+                    name='rec_{0}.tif'.format(hashlib.sha256(url.split('?')[0].encode('utf-8')).hexdigest()[:32])
+                    self.remote[name]=url
+                    links['downloadUrl']='{0}files/{1}'.format(MARK,name)
+        served=json.dumps(resp_vp).replace(upstream,MARK)
+        if isinstance(response,dict):
+            for token in ('accessToken','refreshToken'):
+                if token in response:
+                    response[token]='recorded-{0}'.format(token)
+        return served.encode('utf-8'),json.dumps(resp_vp).replace(upstream,MARK).encode('utf-8')
+
+
+def api(base_url, APIToken='standin', catalog=None, **kwargs):
+    '''
+    WaPOR API client of the server at base_url
+
+    The client reads and caches its catalog in a copy of catalog (default
+    catalog_2.pkl of this package) in a temporary directory, so that
+    getCatalog(cached=False) never overwrites the catalog of the real API.
+    The copy is removed when the client is garbage collected or at exit.
+    '''
+    if catalog is None:
+        catalog=os.path.join(os.path.dirname(__file__),'catalog_2.pkl')
+    client=__WaPOR_API_class(APIToken,base_url=base_url,**kwargs)
+    Dir=tempfile.mkdtemp(prefix='wapor_standin_')
+    client.cached_catalog={version:os.path.join(Dir,os.path.basename(catalog))
+                           for version in client.cached_catalog}
+    for catalog_pickle in client.cached_catalog.values():
+        shutil.copyfile(catalog,catalog_pickle)
+    weakref.finalize(client,shutil.rmtree,Dir,True)
+    return client
+
+
+def geotiff(array, pixel_size, origin, nodata=NODATA):
+    '''
+    Uncompressed single band int16 GeoTIFF in EPSG:4326
+
+    Parameters
+    ----------
+    array : ndarray
+        int16 pixel values, north up
+    pixel_size : tuple
+        (x, y) pixel size in degrees
+    origin : tuple
+        (x, y) of the upper left corner
+
+    Returns
+    -------
+    bytes
+    '''
+    height,width=array.shape
+    data=np.ascontiguousarray(array,dtype='<i2').tobytes()
+    geokeys=[1,1,0,3, 1024,0,1,2, 1025,0,1,1, 2048,0,1,4326]
+    #tag, type (3 SHORT, 4 LONG, 12 DOUBLE, 2 ASCII), values
+    tags=[(256,4,[width]),(257,4,[height]),(258,3,[16]),(259,3,[1]),
+          (262,3,[1]),(273,4,[0]),(277,3,[1]),(278,4,[height]),
+          (279,4,[len(data)]),(284,3,[1]),(339,3,[2]),
+          (33550,12,[pixel_size[0],pixel_size[1],0.]),
+          (33922,12,[0.,0.,0.,origin[0],origin[1],0.]),
+          (34735,3,geokeys),
+          (42113,2,'{0}\0'.format(nodata).encode('ascii'))]
+    formats={2:'s',3:'H',4:'I',12:'d'}
+    extra_offset=8+2+12*len(tags)+4
+    entries=[]
+    extra=b''
+    for tag,kind,values in tags:
+        if kind==2:
+            payload=values
+            count=len(values)
+        else:
+            payload=struct.pack('<{0}{1}'.format(len(values),formats[kind]),*values)
+            count=len(values)
+        entries.append([tag,kind,count,payload])
+        if len(payload)>4:
+            extra+=payload
+            if len(extra)%2:
+                extra+=b'\0'
+    strip_offset=extra_offset+len(extra)
+    ifd=struct.pack('<H',len(entries))
+    offset=extra_offset
+    for tag,kind,count,payload in entries:
+        if tag==273:
+            payload=struct.pack('<I',strip_offset)
+        if len(payload)>4:
+            value=struct.pack('<I',offset)
+            offset+=len(payload)+len(payload)%2
+        else:
+            value=payload.ljust(4,b'\0')
+        ifd+=struct.pack('<HHI',tag,kind,count)+value
+    ifd+=struct.pack('<I',0)
+    return b'II*\0'+struct.pack('<I',8)+ifd+extra+data
+
+
+def _timeMembers(dims_code, years):
+    '''
+    (code, caption, raster id part) of the periods of time dimension dims_code
+    '''
+    first,last=years
+    periods=[]
+    if dims_code=='LTP':
+        periods.append((datetime.date(first,1,1),datetime.date(last+1,1,1),
+                        '{0}-{1}'.format(first,last),'lt'))
+    for year in range(first,last+1):
+        if dims_code=='YEAR':
+            periods.append((datetime.date(year,1,1),datetime.date(year+1,1,1),
+                            str(year),'{0:02d}'.format(year%100)))
+            continue
+        for month in range(1,13):
+            start=datetime.date(year,month,1)
+            end=datetime.date(year+month//12,month%12+1,1)
+            if dims_code=='MONTH':
+                periods.append((start,end,start.strftime('%Y-%m'),
+                                '{0:02d}{1:02d}'.format(year%100,month)))
+            elif dims_code=='DEKAD':
+                bounds=[start,start.replace(day=11),start.replace(day=21),end]
+                for d in range(3):
+                    periods.append((bounds[d],bounds[d+1],
+                                    '{0}-D{1}'.format(start.strftime('%Y-%m'),d+1),
+                                    '{0:02d}{1:02d}'.format(year%100,(month-1)*3+d+1)))
+            elif dims_code=='DAY':
+                for day in range((end-start).days):
+                    date=start+datetime.timedelta(days=day)
+                    periods.append((date,date+datetime.timedelta(days=1),
+                                    date.isoformat(),
+                                    '{0:02d}{1:03d}'.format(year%100,date.timetuple().tm_yday)))
+    return [('[{0},{1})'.format(start.isoformat(),end.isoformat()),caption,part)
+            for start,end,caption,part in periods]
+
+
+def _seed(*values):
+    return int(hashlib.sha256(repr(values).encode('utf-8')).hexdigest()[:16],16)
+
+
+def _list(value):
+    return value if isinstance(value,list) else [] #missing values are NaN in the catalog
+
+
+def _json(resp_vp):
+    return 200,'application/json',json.dumps(resp_vp).encode('utf-8')
+
+
+def _error(status, message):
+    return status,'application/json',json.dumps({'status':status,'message':message}).encode('utf-8')
+
+
+if __name__=='__main__':
+    server=StandInServer(port=8765)
+    print('WaPOR stand-in at {0}'.format(server.base_url))
+    server.httpd.serve_forever()
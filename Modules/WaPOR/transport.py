@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transport shared by all requests of the WaPOR API class.
+
+One requests.Session keeps connections to the server alive between catalog,
+query, job and raster calls. GET requests that time out, fail to connect or
+get a 429/5xx answer are retried with exponential backoff and jitter. POST
+requests submit jobs and sign in, so they are only retried when they did not
+reach the server or the server rejected them with 429/503, a lost answer
+would otherwise create a second job. Latency and retries are counted per
+endpoint.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class Transport(object):
+    def __init__(self, pool_size=16, timeout=(10, 300), retries=5,
+                 backoff=1, max_backoff=60,
+                 retry_status=(429, 500, 502, 503, 504),
+                 rejected_status=(429, 503)):
+        '''
+        pool_size: int
+            number of keep-alive connections kept per host
+        timeout: float or tuple
+            (connect, read) timeout in seconds of every request
+        retries: int
+            number of retries after a failed request
+        backoff: float
+            base of the exponential wait in seconds, the n-th retry waits a
+            random time between 0 and min(backoff*2**n, max_backoff)
+        retry_status: tuple
+            HTTP status codes that are retried
+        rejected_status: tuple
+            HTTP status codes of answers that reject a request without
+            processing it, the only answers after which a POST is retried
+
+        Only idempotent requests (GET, HEAD, PUT, DELETE, OPTIONS) are
+        retried after a timeout, a broken connection or a retry_status
+        answer, see retryable.
+        '''
+        self.timeout=timeout
+        self.retries=retries
+        self.backoff=backoff
+        self.max_backoff=max_backoff
+        self.retry_status=retry_status
+        self.rejected_status=rejected_status
+        self.session=requests.Session()
+        adapter=HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        self.stats={}
+        self._lock=threading.Lock()
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request('GET',url,endpoint=endpoint,**kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request('POST',url,endpoint=endpoint,**kwargs)
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        '''
+        Send a request, retrying connection errors, timeouts and retry_status
+        answers as far as retryable allows. Returns the last response, or
+        raises the last connection error when no response was received at all.
+
+        endpoint: str
+            name under which the request is counted, default the last part
+            of the url path
+        '''
+        if endpoint is None:
+            endpoint=self._endpoint(url)
+        kwargs.setdefault('timeout',self.timeout)
+        attempt=0
+        while True:
+            start=time.perf_counter()
+            resp=None
+            try:
+                resp=self.session.request(method,url,**kwargs)
+                error=None
+            except (requests.ConnectionError,requests.Timeout) as e:
+                error=e
+            self._count(endpoint,time.perf_counter()-start,
+                        retry=attempt>0,
+                        error=error is not None or resp.status_code>=400)
+            if error is None and resp.status_code not in self.retry_status:
+                return resp
+            status=resp.status_code if resp is not None else None
+            sent=error is None or not self._connect_error(error)
+            if attempt>=self.retries or not self.retryable(method,status,sent):
+                if error is not None:
+                    raise error
+                return resp
+            time.sleep(self._wait(attempt,
+                                  resp.status_code if resp is not None else None,
+                                  resp.headers if resp is not None else None))
+            attempt+=1
+
+    def retryable(self, method, status=None, sent=True):
+        '''
+        True if a failed request may be sent again
+
+        method: str
+            HTTP method of the request
+        status: int
+            HTTP status of the answer, None when no answer was received
+        sent: bool
+            False if the connection failed before the request was sent
+        '''
+        if method.upper() in ('GET','HEAD','PUT','DELETE','OPTIONS'):
+            return status is None or status in self.retry_status
+        if status is None:
+            return not sent
+        return status in self.rejected_status
+
+    def _connect_error(self, error):
+        '''
+        True if error happened while connecting, before the request was sent
+        '''
+        if isinstance(error,requests.ConnectTimeout):
+            return True
+        reason=error.args[0] if error.args else None
+        reason=getattr(reason,'reason',reason)
+        return isinstance(reason,(ConnectTimeoutError,NewConnectionError))
+
+    def _wait(self, attempt, status=None, headers=None):
+        '''
+        Seconds to wait before retry number attempt+1 of a request that got
+        the HTTP status (None when no response was received) and headers
+        '''
+        delay=min(self.backoff*2**attempt,self.max_backoff)
+        if status==429:
+            try:
+                #server asks to wait at least Retry-After seconds, up to max_backoff
+                return min(max(float(headers['Retry-After']),delay),self.max_backoff)
+            except (KeyError,TypeError,ValueError):
+                pass
+        return random.uniform(0,delay)
+
+    def _endpoint(self, url):
+        parts=[part for part in urlparse(url).path.split('/') if part]
+        return parts[-1] if parts else urlparse(url).netloc
+
+    def _count(self, endpoint, seconds, retry=False, error=False):
+        with self._lock:
+            stats=self.stats.setdefault(endpoint,{'requests':0,'retries':0,
+                                                  'errors':0,'total_time':0.0,
+                                                  'max_time':0.0})
+            stats['requests']+=1
+            stats['retries']+=int(retry)
+            stats['errors']+=int(error)
+            stats['total_time']+=seconds
+            stats['max_time']=max(stats['max_time'],seconds)
+
+    def report(self):
+        '''
+        Per endpoint: number of requests, retries and error answers, and the
+        mean and maximum latency in seconds
+        '''
+        with self._lock:
+            report={}
+            for endpoint,stats in self.stats.items():
+                report[endpoint]=dict(stats)
+                report[endpoint]['mean_time']=stats['total_time']/stats['requests']
+        return report
+
+    def reset(self):
+        with self._lock:
+            self.stats={}
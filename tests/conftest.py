@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+The notebooks import WaPOR and GIS_functions from the Modules folder, the
+tests do the same.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Modules'))
+os.environ.setdefault('WAPOR_API_TOKEN', 'test-token')
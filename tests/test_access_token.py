@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import types
+
+from WaPOR import standin
+from WaPOR.access_token import TokenManager
+
+
+def _signed_in(token, expires_in=3600):
+    return {'response': {'accessToken': token, 'refreshToken': 'refresh', 'expiresIn': expires_in}}
+
+
+def test_one_sign_in_for_waiting_threads():
+    calls = []
+    def sign_in():
+        calls.append(1)
+        time.sleep(0.05)
+        return _signed_in('token')
+    tokens = TokenManager(sign_in, None)
+    threads = [threading.Thread(target=tokens.get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert tokens.get() == 'token'
+
+
+def test_failed_sign_in_is_not_repeated_by_waiting_threads():
+    calls = []
+    def sign_in():
+        calls.append(1)
+        time.sleep(0.05)
+        return {'message': 'Invalid API key'}
+    tokens = TokenManager(sign_in, None, retry_wait=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tokens.get())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [None] * 8
+    tokens.retry_wait = 0
+    tokens._retry_at = 0.0
+    tokens.get()
+    assert len(calls) == 2
+
+
+def test_failed_refresh_falls_back_to_sign_in():
+    calls = []
+    def sign_in():
+        calls.append('sign-in')
+        return _signed_in('token-{0}'.format(len(calls)), expires_in=0)
+    def refresh(RefreshToken):
+        calls.append('refresh')
+        raise ValueError('no json answer')
+    tokens = TokenManager(sign_in, refresh, margin=0)
+    assert tokens.get() == 'token-1'
+    assert tokens.get() == 'token-3'
+    assert calls == ['sign-in', 'refresh', 'sign-in']
+
+
+def test_rejected_token_is_renewed_once():
+    API = standin.api('http://127.0.0.1:1/gismgr/api/v1/')
+    issued = iter(['first', 'second', 'third'])
+    API.tokens = TokenManager(lambda: _signed_in(next(issued)), lambda RefreshToken: {})
+    sent = []
+    def request(method, url, **kwargs):
+        sent.append(kwargs['headers']['Authorization'])
+        status = 401 if len(sent) == 1 else 200
+        return types.SimpleNamespace(status_code=status, headers={})
+    API.transport.session.request = request
+    resp = API._authorized('POST', API.path_query, 'query/CropRaster', json={})
+    assert resp.status_code == 200
+    assert sent == ['Bearer first', 'Bearer second']
+    # a token that keeps being rejected is not renewed in a loop
+    sent.clear()
+    API.transport.session.request = lambda method, url, **kwargs: (sent.append(1), types.SimpleNamespace(status_code=401, headers={}))[1]
+    assert API._authorized('GET', API.path_download, 'download').status_code == 401
+    assert len(sent) == 2
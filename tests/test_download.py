@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Downloads against the local stand-in of the WaPOR API, see WaPOR.standin.
+"""
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+
+import WaPOR
+from WaPOR import standin
+
+PERIOD = dict(Startdate='2009-01-01', Enddate='2009-01-31', latlim=[7.0, 7.05], lonlim=[38.0, 38.05])
+
+
+@pytest.fixture
+def server():
+    with standin.StandInServer() as server, server.install() as API:
+        API.poll_interval = 0.01
+        yield server
+
+
+def _crops(server):
+    return server.stats()['requests'].get('query/CropRaster', 0)
+
+
+def test_download_is_skipped_when_finished(server, tmp_path):
+    import os
+    from WaPOR.manifest import open_manifest
+    Dir = WaPOR.download_dekadal(str(tmp_path), data='AETI', level=2, Waitbar=0, **PERIOD)
+    entries = open_manifest(Dir).entries
+    assert len(entries) == 3
+    assert all(os.path.exists(os.path.join(Dir, entry['file'])) for entry in entries.values())
+    crops = _crops(server)
+    WaPOR.download_dekadal(str(tmp_path), data='AETI', level=2, Waitbar=0, **PERIOD)
+    assert _crops(server) == crops
+
+
+def test_interrupted_transfer_is_resumed(server, tmp_path, monkeypatch):
+    import os
+    from WaPOR import download_pool
+    from WaPOR.manifest import open_manifest
+    monkeypatch.setattr(download_pool, 'VSIMEM_MAX', 0)
+    write_stream = download_pool._write_stream
+
+    def interrupted(resp, download_file, mode, bar):
+        with open(download_file, mode) as fh:
+            fh.write(next(resp.iter_content(chunk_size=100)))
+        raise IOError('connection lost')
+
+    monkeypatch.setattr(download_pool, '_write_stream', interrupted)
+    Dir = WaPOR.download_dekadal(str(tmp_path), data='AETI', level=2, Waitbar=0, **PERIOD)
+    entries = open_manifest(Dir).entries
+    assert {entry['status'] for entry in entries.values()} == {'partial'}
+    assert all(os.path.getsize(os.path.join(Dir, raster_id + '.tif.part')) == 100 for raster_id in entries)
+    monkeypatch.setattr(download_pool, '_write_stream', write_stream)
+    crops = _crops(server)
+    WaPOR.download_dekadal(str(tmp_path), data='AETI', level=2, Waitbar=0, **PERIOD)
+    assert _crops(server) == crops
+    assert {entry['status'] for entry in entries.values()} == {'complete'}
+    assert not [fh for fh in os.listdir(Dir) if fh.endswith('.part')]
+
+
+def test_cached_rasters_are_not_downloaded_again(server, tmp_path):
+    import filecmp
+    import os
+    from WaPOR.cache import RasterCache
+    cache = RasterCache(str(tmp_path / 'cache'))
+    first = WaPOR.download_dekadal(str(tmp_path / 'a'), data='AETI', level=2, Waitbar=0,
+                                   cache=cache, **PERIOD)
+    crops = _crops(server)
+    second = WaPOR.download_dekadal(str(tmp_path / 'b'), data='AETI', level=2, Waitbar=0,
+                                    cache=cache, **PERIOD)
+    assert _crops(server) == crops
+    assert cache.hits == 3
+    for fh in os.listdir(first):
+        if fh.endswith('.tif'):
+            assert filecmp.cmp(os.path.join(first, fh), os.path.join(second, fh), shallow=False)
+
+
+def test_download_batch_keeps_download_functions(server, tmp_path):
+    dirs = WaPOR.download_batch(str(tmp_path), [('AETI', 'dekadal', 2), ('AETI', 'yearly', 2)],
+                                Waitbar=0, **PERIOD)
+    assert all(Dir is not None for Dir in dirs.values())
+    assert callable(WaPOR.download_dekadal)
+    assert callable(WaPOR.download_yearly)
+
+
+def test_pixel_timeseries_batch_falls_back_for_missing_steps(server, tmp_path):
+    Dir = WaPOR.download_dekadal(str(tmp_path), data='AETI', level=2, Waitbar=0,
+                                 Startdate='2009-01-01', Enddate='2009-01-15',
+                                 latlim=PERIOD['latlim'], lonlim=PERIOD['lonlim'])
+    inside, outside = [38.025, 7.025], [39.5, 8.5]
+    df = WaPOR.API.getPixelTimeseriesBatch([inside, outside], 'L2_AETI_D',
+                                           time_range='2009-01-01,2009-01-31', Dir=Dir)
+    avail = WaPOR.API.getAvailData('L2_AETI_D', time_range='2009-01-01,2009-01-31')
+    for point_id in (0, 1):
+        rows = df[df['point_id'] == point_id]
+        assert sorted(rows['time']) == sorted(avail['time_code'])
+    assert set(df[df['point_id'] == 0]['source']) == {'local', 'remote'}
+    assert set(df[df['point_id'] == 1]['source']) == {'remote'}
+    # rasters of another cube in the same directory are not used
+    other = WaPOR.API.getPixelTimeseriesBatch([inside], 'L2_T_D',
+                                              time_range='2009-01-01,2009-01-31', Dir=Dir)
+    assert set(other['source']) == {'remote'}
+
+
+@pytest.mark.parametrize('mosaic', ['vrt', 'tif'])
+def test_tiled_download_is_recorded_in_manifest(server, tmp_path, mosaic):
+    import os
+    from WaPOR.manifest import open_manifest
+    Dir = WaPOR.download_dekadal(str(tmp_path), data='AETI', level=2, Waitbar=0,
+                                 tile_size=0.025, mosaic=mosaic, **PERIOD)
+    entries = open_manifest(Dir).entries
+    assert entries
+    for raster_id, entry in entries.items():
+        assert entry['file'] == '{0}.{1}'.format(raster_id, mosaic)
+        assert os.path.exists(os.path.join(Dir, entry['file']))
+    tiles = open_manifest(os.path.join(Dir, 'tiles')).entries
+    assert len(tiles) == (4 * len(entries) if mosaic == 'vrt' else 0)
+
+
+def test_local_pixel_timeseries_of_compact_rasters_is_scaled(server, tmp_path):
+    point = [38.025, 7.025]
+    tables = []
+    for compact in (False, True):
+        Dir = WaPOR.download_dekadal(str(tmp_path / str(compact)), data='AETI', level=2, Waitbar=0,
+                                     compact=compact, **PERIOD)
+        tables.append(WaPOR.API.getPixelTimeseriesBatch([point], 'L2_AETI_D',
+                                                        time_range='2009-01-01,2009-01-31', Dir=Dir))
+    assert set(tables[1]['source']) == {'local'}
+    assert list(tables[1]['value']) == pytest.approx(list(tables[0]['value']))
+
+
+@pytest.mark.parametrize('resample', ['near', 'bilinear'])
+def test_resampled_compact_rasters_hold_scaled_values(server, tmp_path, resample):
+    import glob
+    import numpy as np
+    from osgeo import gdal
+    from WaPOR import GIS_functions as gis
+    fhs = {}
+    for compact in (False, True):
+        Dir = WaPOR.download_dekadal(str(tmp_path / str(compact)), data='AETI', level=2, Waitbar=0,
+                                     compact=compact, **PERIOD)
+        fhs[compact] = sorted(glob.glob(Dir + '/*.tif'))
+    source = fhs[False][0]
+    outputs = {compact: gis.MatchProjResNDV(source, fhs[compact], str(tmp_path / 'resample' / str(compact)),
+                                            resample=resample)
+               for compact in (False, True)}
+    for fh, fh_compact in zip(outputs[False], outputs[True]):
+        Band = gdal.Open(fh_compact).GetRasterBand(1)
+        assert Band.DataType == gdal.GDT_Float32
+        assert 'MULTIPLIER' not in Band.GetMetadata()
+        # raw values, as rasterio reads them
+        np.testing.assert_allclose(Band.ReadAsArray(), gdal.Open(fh).GetRasterBand(1).ReadAsArray(),
+                                   rtol=1e-6, atol=1e-3)
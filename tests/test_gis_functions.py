@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+GIS_functions on small synthetic rasters, see WaPOR.standin.geotiff.
+"""
+import filecmp
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo.gdal')
+
+from WaPOR import GIS_functions as gis
+from WaPOR import progress
+from WaPOR import standin
+
+
+def _write(fh, array, pixel_size, origin):
+    with open(fh, 'wb') as f:
+        f.write(standin.geotiff(array, pixel_size, origin))
+    return fh
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    rng = np.random.default_rng(0)
+    source = _write(str(tmp_path / 'source.tif'), np.zeros((30, 40), np.int16),
+                    (1 / 1120., 1 / 1120.), (38.0, 7.05))
+    targets = [_write(str(tmp_path / 'target_{0}.tif'.format(i)),
+                      rng.integers(-50, 1000, size=(8, 11), dtype=np.int16),
+                      (1 / 448., 1 / 448.), (37.99, 7.06))
+               for i in range(3)]
+    return source, targets
+
+
+@pytest.mark.parametrize('resample', ['near', 'bilinear'])
+def test_parallel_resample_matches_serial(rasters, tmp_path, resample):
+    source, targets = rasters
+    serial = gis.MatchProjResNDV(source, targets, str(tmp_path / 'serial'), resample=resample)
+    parallel = gis.MatchProjResNDV(source, targets, str(tmp_path / 'parallel'), resample=resample,
+                                   processes=2, multithread=True)
+    assert [os.path.basename(fh) for fh in parallel] == [os.path.basename(fh) for fh in serial]
+    for fh_serial, fh_parallel in zip(serial, parallel):
+        assert filecmp.cmp(fh_serial, fh_parallel, shallow=False)
+
+
+def test_arrays_on_a_vrt_grid_are_written_as_geotiff(rasters, tmp_path):
+    source, targets = rasters
+    vrt = gis.MatchProjResNDV(source, targets[:1], str(tmp_path / 'vrt'), output_format='VRT')[0]
+    assert vrt.endswith('.vrt')
+    grid = gis.GridSpec.from_file(vrt)
+    Array = gis.OpenAsArray(vrt, nan_values=True)
+    fh = str(tmp_path / 'created.tif')
+    gis.CreateGeoTiff(fh, Array, grid)
+    assert gis.GridSpec.from_file(fh).driver_name == 'GTiff'
+    fh = str(tmp_path / 'blocks.tif')
+    with gis.BlockWriter(fh, vrt) as writer:
+        for window, Block in gis.IterBlocks(vrt):
+            writer.write(window, Block)
+    assert gis.GridSpec.from_file(fh).driver_name == 'GTiff'
+
+
+def test_scaled_vrt_output_warns(rasters, tmp_path):
+    source, targets = rasters
+    with pytest.warns(UserWarning):
+        output = gis.MatchProjResNDV(source, targets[:1], str(tmp_path / 'scaled'), scale=0.1,
+                                     output_format='VRT')
+    assert output[0].endswith('.tif')
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_resampled_files_are_reported(rasters, tmp_path, processes):
+    source, targets = rasters
+    bar = progress.Progress(0, name='download')
+    gis.MatchProjResNDV(source, targets, str(tmp_path / 'reported'), processes=processes,
+                        Waitbar=bar)
+    snapshot = bar.snapshot()
+    assert (snapshot['total'], snapshot['done'], snapshot['errors']) == (len(targets), len(targets), 0)
+
+
+def test_geo_info_projection_is_not_shared(rasters):
+    source, _ = rasters
+    first = gis.GetGeoInfo(source)[5]
+    first.ImportFromEPSG(3857)
+    assert gis.GetGeoInfo(source)[5] is not first
+    assert gis.GetGeoInfo(source)[5].GetAuthorityCode(None) == '4326'
+
+
+def test_grids_with_nan_ndv_are_equal():
+    import pickle
+    GeoT = (38.0, 0.1, 0.0, 7.0, 0.0, -0.1)
+    grid = gis.GridSpec('GTiff', float('nan'), 10, 10, GeoT, '')
+    other = gis.GridSpec('GTiff', float('nan'), 10, 10, GeoT, '')
+    assert grid == other and hash(grid) == hash(other)
+    assert pickle.loads(pickle.dumps(grid)) == grid
+    assert grid != gis.GridSpec('GTiff', -9999, 10, 10, GeoT, '')
+
+
+@pytest.mark.parametrize('values, src_type', [
+    ([[1.7, -1.7, np.nan, 2.5]], 'Float32'),
+    ([[1, -2, 300, -9999]], 'Int16'),
+    ([[0, 7, 200, 255]], 'Byte'),
+])
+@pytest.mark.parametrize('dtype', ['float32', 'float64', 'int16', 'int32', 'uint8', 'int8'])
+def test_read_as_array_matches_astype(tmp_path, values, src_type, dtype):
+    from osgeo import gdal
+    fh = str(tmp_path / 'values.tif')
+    Array = np.array(values)
+    DataSet = gdal.GetDriverByName('GTiff').Create(fh, Array.shape[1], Array.shape[0], 1,
+                                                   gdal.GetDataTypeByName(src_type))
+    DataSet.GetRasterBand(1).WriteArray(Array)
+    DataSet = None
+    Band = gdal.Open(fh).GetRasterBand(1)
+    with np.errstate(invalid='ignore'):
+        expected = Band.ReadAsArray().astype(dtype)
+        read = gis.OpenAsArray(fh, dtype=dtype)
+        into = gis.OpenAsArray(fh, out=np.empty_like(expected))
+    assert read.dtype == expected.dtype and into.dtype == expected.dtype
+    np.testing.assert_array_equal(read, expected)
+    np.testing.assert_array_equal(into, expected)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+
+import pytest
+
+import WaPOR
+
+
+def test_import_sends_no_request():
+    assert 'API' not in vars(WaPOR)
+
+
+def test_bound_submodule_keeps_main():
+    # the import system binds a submodule to the package like this
+    fake = types.ModuleType('WaPOR.download_fake')
+    fake.main = lambda: 'main'
+    previous = vars(WaPOR).get('download_daily')
+    try:
+        setattr(WaPOR, 'download_daily', fake)
+        assert WaPOR.download_daily is fake.main
+    finally:
+        vars(WaPOR).pop('download_daily')
+        if previous is not None:
+            vars(WaPOR)['download_daily'] = previous
+
+
+def test_download_function_after_submodule_import():
+    pytest.importorskip('osgeo.gdal')
+    import WaPOR.download_dekadal
+    import WaPOR.download_yearly
+    from WaPOR.download_dekadal import download_jobs
+    from WaPOR import benchmark
+    assert WaPOR.download_dekadal is sys.modules['WaPOR.download_dekadal'].main
+    assert WaPOR.download_yearly is sys.modules['WaPOR.download_yearly'].main
+    assert callable(WaPOR.download_dekadal)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from WaPOR import progress
+
+
+def test_retried_items_are_counted_once():
+    bar = progress.progress(0, 0)
+    first = progress.progress(bar, 4)
+    for i in range(4):
+        first.item(i, None if i < 2 else IOError('failed'))
+    bar.retry(2)
+    second = progress.progress(bar, 2)
+    assert second is bar
+    for i in (2, 3):
+        second.item(i)
+    snapshot = bar.snapshot()
+    assert (snapshot['total'], snapshot['done'], snapshot['errors'], snapshot['retries']) == (4, 4, 0, 2)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import types
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from WaPOR.transport import Transport
+
+
+def _session(calls, error=None, status=200):
+    def request(method, url, **kwargs):
+        calls.append(method)
+        if error is not None:
+            raise error
+        return types.SimpleNamespace(status_code=status, headers={})
+    return request
+
+
+def _connect_error():
+    return requests.ConnectionError(MaxRetryError(None, 'http://x/', NewConnectionError(None, 'refused')))
+
+
+@pytest.mark.parametrize('method,error,status,attempts', [
+    ('GET', requests.ReadTimeout(), None, 4),
+    ('GET', None, 500, 4),
+    ('GET', _connect_error(), None, 4),
+    # the server may have created the job, do not submit it again
+    ('POST', requests.ReadTimeout(), None, 1),
+    ('POST', None, 500, 1),
+    ('POST', None, 502, 1),
+    # rejected or never sent, safe to send again
+    ('POST', None, 429, 4),
+    ('POST', None, 503, 4),
+    ('POST', _connect_error(), None, 4),
+    ('POST', requests.ConnectTimeout(), None, 4),
+])
+def test_retries(method, error, status, attempts):
+    transport = Transport(retries=3, backoff=0)
+    calls = []
+    transport.session.request = _session(calls, error, status)
+    try:
+        transport.request(method, 'http://x/query/CropRaster')
+    except requests.RequestException:
+        assert error is not None
+    assert len(calls) == attempts
+
+
+def test_retry_after_is_capped():
+    transport = Transport(backoff=1, max_backoff=5)
+    assert transport._wait(0, 429, {'Retry-After': '1000'}) == 5
+    assert transport._wait(0, 429, {'Retry-After': '3'}) == 3
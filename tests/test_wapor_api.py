@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+
+import WaPOR
+from WaPOR import standin
+
+
+def test_avail_data_refreshes_stale_members():
+    with standin.StandInServer() as server:
+        API = standin.api(server.base_url)
+        df = API.getAvailData('L2_AETI_D', time_range='2009-01-01,2009-02-01')
+        assert len(df) == 3
+        # members cached before the last dekad was published
+        key = (API.version, 'L2_AETI_D', 'DEKAD')
+        cached, members = API.members_cache[key]
+        API.members_cache[key] = (cached, members[members['code'] != df['time_code'].iloc[-1]])
+        refreshed = API.getAvailData('L2_AETI_D', time_range='2009-01-01,2009-02-01')
+        assert list(refreshed['time_code']) == list(df['time_code'])
+        assert len(API.members_cache[key][1]) == len(members)
+
+
+class _Point:
+    def __init__(self, x, y):
+        self.__geo_interface__ = {'type': 'Point', 'coordinates': [x, y]}
+
+
+class _Features:
+    '''GeoDataFrame stand-in: geometry series and crs'''
+    def __init__(self, points):
+        import pandas as pd
+        self.geometry = pd.Series([_Point(x, y) for x, y in points], index=[3, 7])
+        self.crs = type('CRS', (), {'to_epsg': lambda self: 4326})()
+
+
+def test_async_area_timeseries_matches_sync():
+    import asyncio
+    from WaPOR.AsyncWaporAPI import AsyncWaPORClient
+    features = _Features([(38.0, 7.0), (38.5, 7.5)])
+    time_range = '2009-01-01,2009-02-01'
+
+    async def area(base_url):
+        async with AsyncWaPORClient('standin', base_url=base_url) as client:
+            client.poll_interval = 0.01
+            table = await client.getAreaTimeseries(features, 'L2_AETI_D', time_range=time_range)
+            return table, len(client.area_cache)
+
+    with standin.StandInServer() as server:
+        API = standin.api(server.base_url)
+        API.poll_interval = 0.01
+        expected = API.getAreaTimeseries(features, 'L2_AETI_D', time_range=time_range)
+        table, cached = asyncio.run(area(server.base_url))
+    assert list(table.columns) == list(expected.columns)
+    assert list(table['feature_id'].unique()) == [3, 7]
+    assert table.equals(expected)
+    assert cached == 2
+
+
+def test_install_restores_api(monkeypatch):
+    API = object()
+    monkeypatch.setattr(WaPOR, 'API', API, raising=False)
+    monkeypatch.setattr(WaPOR, 'APIToken', 'token', raising=False)
+    with standin.StandInServer() as server:
+        with server.install() as client:
+            assert WaPOR.API is client
+            assert client.path_query.startswith(server.base_url)
+        assert WaPOR.API is API
+        assert WaPOR.APIToken == 'token'
+
+
+def test_standin_client_has_own_catalog():
+    package_catalog = os.path.join(os.path.dirname(WaPOR.__file__), 'catalog_2.pkl')
+    mtime = os.stat(package_catalog).st_mtime_ns
+    with standin.StandInServer() as server:
+        API = standin.api(server.base_url)
+        catalog_pickle = API.cached_catalog[API.version]
+        assert os.path.dirname(catalog_pickle) != os.path.dirname(package_catalog)
+        df = API.getCatalog(cached=False)
+    assert len(df) == len(server.cubes)
+    assert os.stat(package_catalog).st_mtime_ns == mtime
+
+
+def test_async_client_leaves_sync_methods_to_its_api():
+    import asyncio
+    from WaPOR.AsyncWaporAPI import AsyncWaPORClient
+
+    async def raster_url(base_url):
+        async with AsyncWaPORClient('standin', base_url=base_url) as client:
+            df = await client.getAvailData('L2_AETI_D', time_range='2009-01-01,2009-02-01')
+            assert not hasattr(client, 'getRasterUrl')
+            assert not hasattr(client, 'getPixelTimeseriesBatch')
+            return await client._run_sync(client.api.getRasterUrl, 'L2_AETI_D',
+                                          df['raster_id'].iloc[0], None)
+
+    with standin.StandInServer() as server:
+        download_url = asyncio.run(raster_url(server.base_url))
+        assert download_url['url'].startswith(server.base_url)